@@ -4,12 +4,13 @@ sys.path.append(os.path.normpath('/cdyw/app/lib/python'))
 ##AppendLibPath
 import json
 import click
-import glob
 import cachepy
 import numpy as np
 import pandas as pd
-from ywqpe import core
-from datetime import datetime
+from ywqpe import core, store
+from ywqpe.io import scan_time
+from ywqpe.scanstore import ScanStore
+from datetime import datetime, timedelta
 from nrsproto.nrsbase_pb2 import *
 
 
@@ -35,7 +36,7 @@ def stn_proc(message):
                         'Lat': lats, 'rain': rains}).sort_values(by=['Datetime'])
 
 
-def single_query(query, queryRes, local_root):
+def single_query(query, queryRes, scans):
     data = query.getRadarProduct(queryRes.handle, 0)
     # 获取雷达信息
     name = 'YW_RADA_'
@@ -43,9 +44,7 @@ def single_query(query, queryRes, local_root):
     for attr_name in ['oflag', 'originator', 'szDateTime', 'ftype', 'deviceId', 'equType']:
         attr_value = getattr(parRes, attr_name)
         name += attr_value + '_'
-    bin_file = open(f'{local_root}/{name}.bin', mode='wb')
-    bin_file.write(data.data)
-    bin_file.close()
+    scans.add(f'{name}.bin', data.data, site=parRes.deviceId)
 
 
 @click.group()
@@ -71,7 +70,11 @@ def qpe(cfg):
             'gridReso': params_dict['params'][3], 'A': params_dict['params'][4],
             'b': params_dict['params'][5], 'stn_num': params_dict['params'][6], 
             'prec_th': params_dict['params'][7], 'dis': params_dict['params'][8], 
-            'K_min': params_dict['params'][9], 'K_max': params_dict['params'][10]}
+            'K_min': params_dict['params'][9], 'K_max': params_dict['params'][10],
+            'storeDir': params_dict.get('storeDir')}
+    # 可选配置：扫描缓存、插值方法、压缩格点、计算精度、OI算子、杂波遮挡掩膜（未配置时使用默认值）
+    pars.update({k: params_dict[k] for k in ['cacheDir', 'cacheSize', 'remap', 'packed', 'dtype',
+                                              'oiDir', 'maskDir'] if k in params_dict})
 
     # 查询雷达数据,获取观测数据的时间分辨率（站号，站号数，XX, 时间戳起始时间，时间戳截止时间，时间个数）
     queryRes0 = query.queryRadarProduct(
@@ -98,8 +101,7 @@ def qpe(cfg):
     # 将雷达数据暂时存储为二进制文件
     local_dir = f"qpe_{pars['timeReso']}min"
     local_root = os.path.join(query.getLocalStorePath(), f'ywqpe/{local_dir}')
-    if not os.path.exists(local_root):
-        os.makedirs(local_root)
+    scans = ScanStore(local_root)  # 按清单索引的本地雷达文件
     # 确定文件请求次数（query_num）、文件满足计算个数（file_lit）、文件的时间差（delta_time）
     if int(pars['timeReso']) == 10:  # 10min
         query_num, file_lit, delta_time = np.around(pars['timeReso'] / file_reso), np.around(pars['timeReso'] / file_reso), 10
@@ -109,25 +111,21 @@ def qpe(cfg):
         query_num, file_lit, delta_time = np.around(pars['timeReso'] / file_reso), np.around((pars['timeReso'] / file_reso) * (3 / 4)), 60
     # print(query_num, file_lit, delta_time)
     if queryRes0.dataCnt > 0:
-        single_query(query, queryRes0, local_root)
+        single_query(query, queryRes0, scans)
         # 第一次单个文件请求需要请求多次
-        if len(os.listdir(local_root)) < query_num:
+        if len(scans) < query_num:
             for i in range(1, int(query_num)):
                 new_queryRes = query.queryRadarProduct(params_dict['stationId'], 
                                                        params_dict['nStation'], 
                                                        params_dict['dependentId'],
                                                        (params_dict['time'] - i * 360) - 360, 
                                                        params_dict['time'] - i * 360, params_dict['limit'], ttl=params_dict['ttl'])
-                single_query(query, new_queryRes, local_root)
+                single_query(query, new_queryRes, scans)
     
     # 判断文件时间连续性(剔除超过10min/30min/1h的数据文件)
-    rad_files = np.array(sorted(glob.glob(f'{local_root}/*.bin')))
-    fp_time_delta = [(datetime.strptime(os.path.split(rad_file)[1].split('_')[4], "%Y%m%d%H%M%S")\
-                    - datetime.strptime(os.path.split(rad_files[-1])[1].split('_')[4], 
-                    "%Y%m%d%H%M%S")).total_seconds() / 60 for rad_file in rad_files]
-    for f in rad_files[np.abs(fp_time_delta) >= delta_time]:
-        os.remove(f)
-    rad_files = sorted(glob.glob(f'{local_root}/*.bin'))
+    scans.prune(timedelta(minutes=delta_time))
+    latest = scans.latest()
+    rad_files = scans.window(latest - timedelta(minutes=delta_time), latest) if latest else []
     # print('rad_files:', rad_files)
     
     # 查询自动站数据
@@ -188,6 +186,7 @@ def qpe(cfg):
         else:
             print(f'##nrs: 0, compute failed!##')
         os.remove(output)
+        store.store_sink(pars, ds_qpe, scan_time(rad_files[-1]), f"M{pars['timeReso']}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,171 @@
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+
+# 解码或插值算法变化时需要递增，使旧缓存失效
+CODE_VERSION = 1
+
+
+class ScanCache:
+    """content-addressed on-disk cache of remapped radar scans
+
+    Each entry is a float32 Cartesian field stored as '<key>.npy' plus its
+    attributes in '<key>.json'. The key hashes the file content, the remap
+    geometry and CODE_VERSION, so renamed or re-fetched copies of a scan hit
+    the same entry. Entries are loaded by mmap, and the least recently used
+    ones are evicted when the cache grows over max_bytes.
+
+    The total size of the '.npy' fields is kept in 'size' and updated by
+    save() under an exclusive flock on '.lock', so the directory is only
+    walked when the cache is over max_bytes (it is then shrunk to
+    low_water * max_bytes) or the size file is missing. The '.json'
+    sidecars (about 100 bytes each) are not counted.
+
+    Parameters
+    ----------
+    root : str
+        cache directory
+    max_bytes : int
+        size bound of the '.npy' fields in the cache
+    low_water : float
+        fraction of max_bytes kept after an eviction
+    """
+
+    def __init__(self, root, max_bytes=20 * 2 ** 30, low_water=0.9):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def content(fp):
+        """sha1 state of a radar file content, shared by the keys of several geometries"""
+        h = hashlib.sha1()
+        with open(fp, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h
+
+    def key(self, fp, content=None, **geometry):
+        """cache key of a radar file remapped with the geometry
+
+        Parameters
+        ----------
+        fp : str
+            radar file path
+        content : hashlib sha1 object
+            content(fp), so that a file remapped onto several grids is only
+            read and hashed once; computed from fp if None
+        geometry : dict
+            remap parameters, e.g. grid_reso, method, beam_width
+
+        Returns
+        -------
+        str
+        """
+        h = (content or self.content(fp)).copy()
+        h.update(json.dumps(geometry, sort_keys=True).encode())
+        h.update(f'v{CODE_VERSION}'.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _lock(self):
+        f = open(os.path.join(self.root, '.lock'), 'w')
+        fcntl.flock(f, fcntl.LOCK_EX)  # 关闭文件时释放
+        return f
+
+    def _read_total(self):
+        """total size of the entries recorded in 'size', None if unknown"""
+        try:
+            with open(os.path.join(self.root, 'size')) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_total(self, total):
+        with open(os.path.join(self.root, 'size'), 'w') as f:
+            f.write(str(total))
+
+    def load(self, key):
+        """load a cached scan
+
+        Returns
+        -------
+        (np.memmap, dict) or None
+            read-only mapped field and its attributes, None if not cached
+        """
+        path = self._path(key)
+        try:
+            with open(f'{path}.json') as f:
+                attrs = json.load(f)
+            arr = np.load(f'{path}.npy', mmap_mode='r')
+            os.utime(f'{path}.npy')  # 更新访问时间，用于LRU淘汰
+        except (FileNotFoundError, ValueError):
+            return None
+        return arr, attrs
+
+    def save(self, key, arr, attrs):
+        """store a scan and evict old entries if the cache is full"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pid = os.getpid()
+        # 先写临时文件再重命名，多进程同时写入时不会读到不完整的文件
+        with open(f'{path}.npy.{pid}.tmp', 'wb') as f:
+            np.save(f, np.asarray(arr, dtype='float32'))
+        with open(f'{path}.json.{pid}.tmp', 'w') as f:
+            json.dump(attrs, f)
+        size = os.path.getsize(f'{path}.npy.{pid}.tmp')
+        with self._lock():
+            try:
+                old = os.path.getsize(f'{path}.npy')
+            except FileNotFoundError:
+                old = 0
+            os.replace(f'{path}.json.{pid}.tmp', f'{path}.json')
+            os.replace(f'{path}.npy.{pid}.tmp', f'{path}.npy')
+            total = self._read_total()
+            if total is not None:
+                total += size - old
+            if total is None or total > self.max_bytes:  # 超出上限或大小未知时才遍历目录
+                total = self._evict(self.low_water * self.max_bytes)
+            self._write_total(total)
+
+    def evict(self, max_bytes=None):
+        """remove least recently used entries until the cache fits max_bytes
+
+        Returns
+        -------
+        int
+            total size of the remaining entries
+        """
+        with self._lock():
+            total = self._evict(self.max_bytes if max_bytes is None else max_bytes)
+            self._write_total(total)
+        return total
+
+    def _evict(self, max_bytes):
+        entries, total = [], 0
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for e in os.scandir(sub.path):
+                if e.name.endswith('.npy'):
+                    try:
+                        st = e.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, e.path[:-4]))
+                    total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            for ext in ('.npy', '.json'):
+                try:
+                    os.remove(path + ext)
+                except FileNotFoundError:
+                    pass
+            total -= size
+        return total
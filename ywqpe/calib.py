@@ -1,6 +1,68 @@
+import os
+import glob
+import fcntl
+import hashlib
 import numpy as np
 import xarray as xr
-from ywqpe.oi_core import oi_calib
+from scipy import sparse
+from scipy.spatial import cKDTree
+from ywqpe.oi_core import oi_calib, rcoef
+
+
+def _corners(lon, lat, pts):
+    """bilinear corners and weights of points on a regular grid
+
+    Returns
+    -------
+    idx : (N, 4) int array
+        flat indices of the corners, 0 for points outside the grid
+    wts : (N, 4) array
+        bilinear weights, NaN for points outside the grid
+    """
+    lon, lat = np.asarray(lon, dtype='f8'), np.asarray(lat, dtype='f8')
+    Nx = len(lon)
+    i = np.searchsorted(lon, pts[:, 0], side='right') - 1
+    j = np.searchsorted(lat, pts[:, 1], side='right') - 1
+    i[pts[:, 0] == lon[-1]] -= 1
+    j[pts[:, 1] == lat[-1]] -= 1
+    out = (i < 0) | (i >= Nx - 1) | (j < 0) | (j >= len(lat) - 1) | np.isnan(pts).any(axis=-1)
+    i, j = np.clip(i, 0, Nx - 2), np.clip(j, 0, len(lat) - 2)
+    tx = (pts[:, 0] - lon[i]) / (lon[i + 1] - lon[i])
+    ty = (pts[:, 1] - lat[j]) / (lat[j + 1] - lat[j])
+    idx = np.stack([j * Nx + i, j * Nx + i + 1, (j + 1) * Nx + i, (j + 1) * Nx + i + 1], axis=-1)
+    wts = np.stack([(1 - tx) * (1 - ty), tx * (1 - ty), (1 - tx) * ty, tx * ty], axis=-1)
+    wts[out] = np.nan
+    return idx, wts
+
+
+def point_interp(field, lon, lat, plon, plat, index=None):
+    """bilinear interpolation of a 2D grid at points, same as DataArray.interp
+
+    Parameters
+    ----------
+    field : 2D array
+        values on the grid (latitude, longitude)
+    lon, lat : 1D array
+        coordinates of the grid (ascending)
+    plon, plat : 1D array
+        coordinates of the points
+    index : 1D int array
+        flat grid indices of a packed 1D field (see core.Grid.index), the
+        other grid cells are NaN
+
+    Returns
+    -------
+    1D array
+        NaN for points outside the grid or next to a NaN grid cell
+    """
+    pts = np.stack([np.asarray(plon, dtype='f8'), np.asarray(plat, dtype='f8')], axis=-1)
+    idx, wts = _corners(lon, lat, pts)
+    field = np.asarray(field).ravel()
+    if index is not None:  # 压缩场：格点索引映射到压缩位置，末尾补NaN
+        pos = np.full(len(lon) * len(lat), len(field), dtype='i8')
+        pos[index] = np.arange(len(index))
+        field, idx = np.append(field, np.nan), pos[idx]
+    return (field[idx] * wts).sum(axis=-1)
 
 
 def oi(da, df, **kargs):
@@ -20,21 +82,298 @@ def oi(da, df, **kargs):
     2D numpy array
         QPE after calibration
     """
+    return oi_array(da.data, da.longitude.data, da.latitude.data, df, **kargs)
+
+
+def oi_array(Rb, lon, lat, df, **kargs):
+    """optimal interpolation of a plain array (see oi)
+
+    Parameters
+    ----------
+    Rb : 2D array
+        radar QPE on the grid (latitude, longitude), or 1D if packed
+    lon, lat : 1D array
+        coordinates of the grid
+    df : pd.DataFrame
+        gauge observation
+    kargs : dict
+        keyword argument for calibration methods, 'index' gives the flat
+        grid indices of a packed Rb (see core.Grid.index)
+
+    Returns
+    -------
+    numpy array
+        QPE after calibration, same shape as Rb
+    """
 
     a = kargs.get('a', 0.2)
     dis = kargs.get('dis', 0.1)
     choice = kargs.get('choice', 0)
-    df['Rb'] = da.interp(
-            longitude=xr.DataArray(df.lon, dims=('index')),
-            latitude=xr.DataArray(df.lat, dims=('index')))\
-        .to_dataframe()[[da.name]]
+    index = kargs.get('index')
+    df['Rb'] = point_interp(Rb, lon, lat, df.lon.values, df.lat.values, index=index)
     df = df.dropna()
 
     Ro = df[['lon', 'lat', 'rain', 'Rb']].values
-    Ra = oi_calib(da.longitude.data, da.latitude.data, da.data, Ro, a, dis, choice)
+    if kargs.get('op_dir'):  # 站网稳定时复用稀疏OI算子
+        op = oi_operator(kargs['op_dir'], lon, lat,
+                         df['Station_Id_c'].values, Ro[:, :2], a, dis, choice)
+        return op.apply(Rb, Ro[:, 2] - Ro[:, 3], cells=index)
+    if index is not None:  # 压缩场只求解范围内格点的权重
+        rows, cols, vals = _oi_weights(lon, lat, Ro[:, :2], a, dis, choice, cells=index)
+        pos = np.searchsorted(index, rows)
+        W = sparse.csr_matrix((vals, (pos, cols)), shape=(len(index), len(Ro)))
+        return Rb + (W @ (Ro[:, 2] - Ro[:, 3])).astype(Rb.dtype)
+    Ra = oi_calib(lon, lat, Rb, Ro, a, dis, choice)
     return Ra
 
 
+def _oi_weights(lon, lat, pts, a, dis, choice, min_pts=5, cells=None):
+    """OI weights of gauges for grid cells (same selection and solve as oi_calib)
+
+    Cells selecting the same gauges share one kernel matrix, so it is solved
+    once for all of them.
+
+    Parameters
+    ----------
+    lon, lat : 1D array
+        coordinates of the grid
+    pts : (N, 2) array
+        lon, lat of gauges
+    a, dis, choice : float, float, int
+        OI parameters as in oi_calib
+    min_pts : int
+        cells with no more than min_pts gauges keep the background
+    cells : 1D int array
+        flat indices of the cells to compute, all cells if None
+
+    Returns
+    -------
+    rows, cols, vals : 1D arrays
+        flat cell index, gauge index and weight of every nonzero weight
+    """
+    Nx = len(lon)
+    if cells is None:
+        cells = np.arange(len(lat) * Nx)
+    cells = np.asarray(cells, dtype='i8')
+    xy = np.stack([lon[cells % Nx], lat[cells // Nx]], axis=-1).astype('f8')
+    if len(pts) == 0 or len(cells) == 0:
+        return np.zeros(0, 'i8'), np.zeros(0, 'i8'), np.zeros(0, 'f8')
+    pairs = cKDTree(pts).sparse_distance_matrix(cKDTree(xy), dis, output_type='ndarray')
+    pairs = pairs[pairs['v'] < dis]
+    order = np.lexsort((pairs['i'], pairs['j']))
+    istn, icell = pairs['i'][order], pairs['j'][order]
+    bounds = np.flatnonzero(np.diff(icell)) + 1
+
+    # 按选中的站点集合分组
+    groups = {}
+    for stn, cell in zip(np.split(istn, bounds), np.split(icell, bounds)):
+        if len(stn) > min_pts:
+            groups.setdefault(stn.tobytes(), (stn, []))[1].append(cell[0])
+
+    rows, cols, vals = [], [], []
+    for stn, icells in groups.values():
+        p = pts[stn]
+        R_kl = np.sqrt(((p[:, np.newaxis, :] - p[np.newaxis, :, :]) ** 2.).sum(axis=-1))
+        u_kl = rcoef(R_kl, a, choice) + np.eye(len(stn)) * 0.01
+        R_kj = np.sqrt(((p[:, np.newaxis, :] - xy[icells][np.newaxis, :, :]) ** 2.).sum(axis=-1))
+        w = np.linalg.solve(u_kl, rcoef(R_kj, a, choice))
+        rows.append(np.repeat(cells[icells], len(stn)))
+        cols.append(np.tile(stn, len(icells)))
+        vals.append(w.T.ravel())
+    if len(rows) == 0:
+        return np.zeros(0, 'i8'), np.zeros(0, 'i8'), np.zeros(0, 'f8')
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+
+
+class OIOperator:
+    """OI analysis increment of a fixed gauge network as a sparse matrix
+
+    For fixed gauges, grid and (a, dis, choice), the increment added by
+    oi_calib is W @ (rain - Rb), with W of shape (Ny * Nx, N).
+
+    Parameters
+    ----------
+    lon, lat : 1D array
+        coordinates of the grid
+    stnids : 1D array
+        gauge ids
+    pts : (N, 2) array
+        lon, lat of gauges
+    a, dis, choice : float, float, int
+        OI parameters as in oi_calib
+    W : scipy.sparse.csr_matrix
+        precomputed weights, built from scratch if None
+    """
+
+    def __init__(self, lon, lat, stnids, pts, a, dis, choice, min_pts=5, W=None):
+        self.lon, self.lat = np.asarray(lon), np.asarray(lat)
+        self.stnids = np.asarray(stnids).astype(str)
+        self.pts = np.asarray(pts, dtype='f8')
+        self.a, self.dis, self.choice, self.min_pts = a, dis, choice, min_pts
+        if W is None:
+            rows, cols, vals = _oi_weights(self.lon, self.lat, self.pts, a, dis, choice, min_pts)
+            W = sparse.csr_matrix((vals, (rows, cols)), shape=(self.size, len(self.pts)))
+        self.W = W
+
+    @property
+    def size(self):
+        return len(self.lat) * len(self.lon)
+
+    @property
+    def grid_key(self):
+        """hash of the grid and OI parameters"""
+        h = hashlib.sha1()
+        for v in (self.lon, self.lat):
+            h.update(np.asarray(v, dtype='f8').tobytes())
+        h.update(f'{self.a}_{self.dis}_{self.choice}_{self.min_pts}'.encode())
+        return h.hexdigest()[:16]
+
+    @property
+    def stn_key(self):
+        """hash of the gauge network (ids and coordinates)"""
+        return _stn_key(self.stnids, self.pts)
+
+    def apply(self, Rb, resid, cells=None):
+        """analysis field Ra = Rb + W @ (rain - Rb)
+
+        Parameters
+        ----------
+        Rb : 2D array
+            background field, or 1D packed on cells
+        resid : 1D array
+            rain - Rb at the gauges, in the order of stnids
+        cells : 1D int array
+            flat grid indices of a packed Rb (see core.Grid.index)
+        """
+        W = self.W if cells is None else self.W[cells]
+        return Rb + (W @ resid).reshape(Rb.shape).astype(Rb.dtype)
+
+    def update(self, stnids, pts):
+        """operator of a new gauge network reusing the unchanged weights
+
+        Only cells within dis of an added, dropped or moved gauge are solved
+        again; the weights of the other cells are copied.
+        """
+        stnids = np.asarray(stnids).astype(str)
+        pts = np.asarray(pts, dtype='f8')
+        old = {(s, p[0], p[1]): i for i, (s, p) in enumerate(zip(self.stnids, self.pts))}
+        new = {(s, p[0], p[1]): i for i, (s, p) in enumerate(zip(stnids, pts))}
+        changed = [k[1:] for k in set(old) ^ set(new)]
+        keep = [(old[k], new[k]) for k in set(old) & set(new)]
+
+        # 受影响的格点：与变化站点距离小于dis
+        cells = np.zeros(0, 'i8')
+        if len(changed) > 0:
+            xx, yy = np.meshgrid(self.lon, self.lat)
+            tree = cKDTree(np.stack([xx.ravel(), yy.ravel()], axis=-1).astype('f8'))
+            near = tree.query_ball_point(np.array(changed), self.dis)
+            cells = np.unique(np.concatenate([np.asarray(c, dtype='i8') for c in near]))
+
+        # 未受影响格点的权重按新站号顺序重排
+        col_map = np.full(len(self.stnids), -1, dtype='i8')
+        for i_old, i_new in keep:
+            col_map[i_old] = i_new
+        W = self.W.tocoo()
+        flag = ~np.isin(W.row, cells)
+        rows, cols, vals = W.row[flag], col_map[W.col[flag]], W.data[flag]
+
+        r, c, v = _oi_weights(self.lon, self.lat, pts, self.a, self.dis, self.choice,
+                              self.min_pts, cells=cells)
+        W = sparse.csr_matrix((np.concatenate([vals, v]),
+                               (np.concatenate([rows, r]), np.concatenate([cols, c]))),
+                              shape=(self.size, len(pts)))
+        return OIOperator(self.lon, self.lat, stnids, pts, self.a, self.dis, self.choice,
+                          self.min_pts, W=W)
+
+    def save(self, fp):
+        W = self.W.tocsr()
+        np.savez(fp, data=W.data, indices=W.indices, indptr=W.indptr, lon=self.lon,
+                 lat=self.lat, stnids=self.stnids, pts=self.pts,
+                 params=np.array([self.a, self.dis, self.choice, self.min_pts], dtype='f8'))
+
+    @classmethod
+    def load(cls, fp):
+        f = np.load(fp)
+        a, dis, choice, min_pts = f['params']
+        W = sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                              shape=(len(f['lat']) * len(f['lon']), len(f['pts'])))
+        return cls(f['lon'], f['lat'], f['stnids'], f['pts'], a, dis, int(choice),
+                   int(min_pts), W=W)
+
+
+def _stn_key(stnids, pts):
+    order = np.argsort(stnids)
+    h = hashlib.sha1()
+    h.update('|'.join(np.asarray(stnids)[order]).encode())
+    h.update(np.asarray(pts, dtype='f8')[order].tobytes())
+    return h.hexdigest()[:16]
+
+
+def _lock(op_dir):
+    f = open(os.path.join(op_dir, '.lock'), 'w')
+    fcntl.flock(f, fcntl.LOCK_EX)  # 关闭文件时释放
+    return f
+
+
+def oi_operator(op_dir, lon, lat, stnids, pts, a, dis, choice, min_pts=5, max_keep=48):
+    """OI operator of a gauge network, loaded from op_dir when possible
+
+    Operators are stored as '<grid_key>_<stn_key>.npz'. If the network is
+    new, the most recent operator of the same grid and parameters is updated
+    incrementally, otherwise it is built from scratch. Processes sharing
+    op_dir (e.g. several accumulation windows) hold an exclusive flock on
+    '.lock' while they look up, update and prune the operators.
+
+    Parameters
+    ----------
+    op_dir : str
+        directory of stored operators
+    lon, lat : 1D array
+        coordinates of the grid
+    stnids : 1D array
+        gauge ids
+    pts : (N, 2) array
+        lon, lat of gauges
+    a, dis, choice : float, float, int
+        OI parameters as in oi_calib
+    max_keep : int
+        number of stored operators kept for each grid
+
+    Returns
+    -------
+    OIOperator
+    """
+    stnids = np.asarray(stnids).astype(str)
+    pts = np.asarray(pts, dtype='f8')
+    os.makedirs(op_dir, exist_ok=True)
+    empty = OIOperator(lon, lat, stnids[:0], pts[:0], a, dis, choice, min_pts)
+    fp = os.path.join(op_dir, f'{empty.grid_key}_{_stn_key(stnids, pts)}.npz')
+    with _lock(op_dir):
+        if os.path.exists(fp):
+            op = OIOperator.load(fp)
+            os.utime(fp)
+            # 存储时站点顺序可能不同
+            order = {s: i for i, s in enumerate(op.stnids)}
+            return OIOperator(lon, lat, stnids, pts, a, dis, choice, min_pts,
+                              W=op.W[:, [order[s] for s in stnids]].tocsr())
+
+        history = sorted(glob.glob(os.path.join(op_dir, f'{empty.grid_key}_*.npz')),
+                         key=os.path.getmtime)
+        if len(history) > 0:
+            op = OIOperator.load(history[-1]).update(stnids, pts)
+        else:
+            op = empty.update(stnids, pts)
+        tmp = f'{fp}.{os.getpid()}.tmp.npz'
+        op.save(tmp)
+        os.replace(tmp, fp)
+        for f in history[:max(len(history) + 1 - max_keep, 0)]:
+            try:
+                os.remove(f)
+            except FileNotFoundError:  # 已被删除
+                pass
+    return op
+
+
 def correct_factor(da, df):
     """correction factor
 
@@ -72,17 +411,36 @@ def global_calibrate(da, df, K_min, K_max):
     xr.DataArray
         new DataArray representing a calibrated QPE result
     """
-    di = da.interp(
-            longitude=xr.DataArray(df.lon, dims=('index')),
-            latitude=xr.DataArray(df.lat, dims=('index')))\
-        .to_dataframe()
-    di['rain'] = df.rain
-    di = di.dropna()
+    K = global_factor(da.data, da.longitude.data, da.latitude.data, df, K_min, K_max)
+    return xr.DataArray(K * da.data, dims=['latitude', 'longitude'])
+
+
+def global_factor(qpe, lon, lat, df, K_min, K_max, index=None):
+    """global correction factor of a plain array (see global_calibrate)
+
+    Parameters
+    ----------
+    qpe : 2D array
+        QPE on the grid (latitude, longitude), or 1D if packed
+    lon, lat : 1D array
+        coordinates of the grid
+    df : pd.DataFrame
+        gauge observation with 'lon', 'lat', and 'rain' as fields
+    index : 1D int array
+        flat grid indices of a packed qpe (see core.Grid.index)
+
+    Returns
+    -------
+    float
+    """
+    R0 = point_interp(qpe, lon, lat, df.lon.values, df.lat.values, index=index)
+    rain = df.rain.values
+    flag = ~np.isnan(R0) & ~np.isnan(rain)
     # di = di[di[da.name] > 0.]  # drop nan from radar qpe
-    if len(di.index) > 0:
-        K = di.rain.values.sum() / di[[da.name]].values.sum()
+    if flag.sum() > 0:
+        K = rain[flag].sum() / R0[flag].sum()
         K = np.clip(K, K_min, K_max)
     else:
         K = 1.
     print(f'global correction factor: {K:.2f}')
-    return xr.DataArray(K * da.data, dims=['latitude', 'longitude'])
+    return K
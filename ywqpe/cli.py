@@ -4,16 +4,15 @@ sys.path.append(os.path.normpath('/cdyw/app/lib/python'))
 ##AppendLibPath
 import json
 import click
-import glob
-import cachepy
-import numpy as np
 import pandas as pd
-from ywqpe import core
-from datetime import datetime
-from nrsproto.nrsbase_pb2 import *
+from ywqpe import clutter, core, evaluate, reproc, store
+from ywqpe.scanstore import ScanStore
+from datetime import datetime, timedelta
 
 
-def sendReq(query, req:NrsReq):
+def sendReq(query, req):
+    from nrsproto.nrsbase_pb2 import NrsResp
+
     data = req.SerializeToString()
     bRet, respT = query.pbReq(data)
     if bRet == False:
@@ -35,12 +34,15 @@ def stn_proc(message):
                         'Lat': lats, 'rain': rains})
 
 
-def single_query(query, queryRes, local_root):
+def bin_time(fp):
+    """observation time of a local file named as '%Y%m%d_%H%M%S.bin'"""
+    return datetime.strptime(os.path.split(fp)[1][:15], "%Y%m%d_%H%M%S")
+
+
+def single_query(query, queryRes, scans):
     data = query.getRadarProduct(queryRes.handle, 0)
     name = os.path.split(data.name)[1].split('.')[0]
-    bin_file = open(f'{local_root}/{name}.bin', mode='wb')
-    bin_file.write(data.data)
-    bin_file.close()
+    scans.add(f'{name}.bin', data.data)
 
 
 @click.group()
@@ -52,6 +54,9 @@ def cli():
 @click.argument('cfg')
 def qpe(cfg):
     """: generate QPE product"""
+    # 服务库只在实时计算时导入，离线命令（reproc、sweep、clutter）不依赖cachepy和nrsproto
+    import cachepy
+    from nrsproto.nrsbase_pb2 import NrsReq, CmdType
 
     # 获取APPName
     appName = os.path.basename(__file__).split(".")[0]
@@ -70,28 +75,24 @@ def qpe(cfg):
         params_dict['time'], 1, ttl=100)
     # 将雷达数据暂时存储为二进制文件
     local_dir = params_dict['params']['local_dir']
-    local_root = os.path.join(query.getLocalStorePath(), 
-                           f'/cdyw/temp/cdyw/localstroe/ywqpe/{local_dir}')
+    local_root = os.path.join(query.getLocalStorePath(), f'ywqpe/{local_dir}')
+    scans = ScanStore(local_root, parse=bin_time)  # 按清单索引的本地雷达文件
     if queryRes.dataCnt > 0:
-        single_query(query, queryRes, local_root)
+        single_query(query, queryRes, scans)
         # 第一次单个文件请求需要请求多次
-        if len(os.listdir(local_root)) < 10:
+        if len(scans) < 10:
             for i in range(1, 10):
                 new_queryRes = query.queryRadarProduct(params_dict['stationId'], 
                                                        params_dict['nStation'], 
                                                        params_dict['dependentId'],
                                                        (params_dict['time'] - i * 360) - 360, 
                                                        params_dict['time'] - i * 360, 1, ttl=100)
-                single_query(query, new_queryRes, local_root)
+                single_query(query, new_queryRes, scans)
     
     # 判断文件时间连续性(剔除超过1h的数据文件)
-    rad_files = np.array(sorted(glob.glob(f'{local_root}/*.bin'))) 
-    fp_time_delta = [(datetime.strptime(rad_file.split('/')[-1][:-4], "%Y%m%d_%H%M%S")\
-                    - datetime.strptime(rad_files[-1].split('/')[-1][:-4], 
-                    "%Y%m%d_%H%M%S")).total_seconds() / 60 for rad_file in rad_files]
-    for f in rad_files[np.abs(fp_time_delta) >= 60]:
-        os.remove(f)
-    rad_files = sorted(glob.glob(f'{local_root}/*.bin'))
+    scans.prune(timedelta(minutes=60))
+    latest = scans.latest()
+    rad_files = scans.window(latest - timedelta(minutes=60), latest) if latest else []
     
     # 查询自动站数据
     req = NrsReq()
@@ -131,9 +132,73 @@ def qpe(cfg):
         else:
             print(f'##nrs: 0, compute failed!##')
         os.remove(output)
+        store.store_sink(dict(params_dict['params'], stationId=params_dict['stationId']), ds_qpe,
+                         datetime.strptime(refdt, "%Y%m%d_%H%M%S"), 'M60')
     else:
         print(f'not enough files, guage={len(stn)}(>30), radar={rad_files}(>7)')
 
 
+@cli.command(name='reproc')
+@click.argument('cfg')
+@click.argument('rad_dir')
+@click.argument('stn_dir')
+@click.argument('out_dir')
+@click.option('--start', required=True, help='start time (%Y%m%d%H%M)')
+@click.option('--end', required=True, help='end time (%Y%m%d%H%M), exclusive')
+@click.option('--windows', default='10,30,60', help='accumulation windows (minutes)')
+@click.option('--workers', default=1, help='number of worker processes')
+@click.option('--io-workers', default=2, help='number of decoding threads per worker')
+def reproc_cmd(cfg, rad_dir, stn_dir, out_dir, start, end, windows, workers, io_workers):
+    """: reprocess archived radar files"""
+
+    params_dict = json.load(open(cfg))
+    params = dict(params_dict['params'], stationId=params_dict['stationId'])
+    reproc.reprocess(rad_dir, stn_dir,
+                     datetime.strptime(start, "%Y%m%d%H%M"),
+                     datetime.strptime(end, "%Y%m%d%H%M"),
+                     params, out_dir,
+                     windows=[int(w) for w in windows.split(',')],
+                     workers=workers, io_workers=io_workers)
+
+
+@cli.command(name='sweep')
+@click.argument('cfg')
+@click.argument('rad_dir')
+@click.argument('stn_dir')
+@click.argument('output')
+@click.option('--start', required=True, help='start time (%Y%m%d%H%M)')
+@click.option('--end', required=True, help='end time (%Y%m%d%H%M), exclusive')
+@click.option('--grid', required=True, help='parameter grid as json, e.g. {"A": [200, 300], "dis": [0.1, 0.2]}')
+@click.option('--window', default=60, help='accumulation window (minutes)')
+@click.option('--step', default=60, help='interval between evaluated windows (minutes)')
+@click.option('--workers', default=1, help='number of worker processes')
+@click.option('--io-workers', default=2, help='number of decoding threads')
+def sweep_cmd(cfg, rad_dir, stn_dir, output, start, end, grid, window, step, workers, io_workers):
+    """: evaluate calibration parameters with leave-one-out OI"""
+
+    params_dict = json.load(open(cfg))
+    params = dict(params_dict['params'], stationId=params_dict['stationId'])
+    samples = evaluate.sample_archive(rad_dir, stn_dir,
+                                      datetime.strptime(start, "%Y%m%d%H%M"),
+                                      datetime.strptime(end, "%Y%m%d%H%M"),
+                                      params, window=window, step=step, io_workers=io_workers)
+    scores = evaluate.sweep(samples, json.loads(grid), params, workers=workers)
+    scores.to_csv(output, index=False)
+    print(scores)
+
+
+@cli.command(name='clutter')
+@click.argument('output')
+@click.argument('sources', nargs=-1, required=True)
+@click.option('--workers', default=4, help='number of decoding threads')
+@click.option('--min-scans', default=50, help='least number of clear-air scans')
+def clutter_cmd(output, sources, workers, min_scans):
+    """: derive the static clutter / blockage mask of a site"""
+
+    mask, meta = clutter.derive_mask(list(sources), workers=workers, min_scans=min_scans)
+    clutter.save_mask(output, mask, meta)
+    print(f'{mask.sum()}/{mask.size} gates masked')
+
+
 if __name__ == '__main__':
     qpe()
@@ -0,0 +1,126 @@
+import os
+import hashlib
+import numpy as np
+from ywqpe.io import hsr_archive
+
+_MASKS = {}
+
+
+def derive_mask(sources, workers=4, rain_dbz=20., clear_frac=0.02, clutter_dbz=35.,
+                clutter_freq=0.5, echo_dbz=0., block_ratio=0.3, block_run=5, min_scans=50):
+    """static clutter and blockage mask from clear-air scans
+
+    Scans are streamed through io.hsr_archive and only clear-air scans (less
+    than clear_frac of the gates reach rain_dbz) are counted. A gate is
+    clutter if it reaches clutter_dbz in more than clutter_freq of them. A
+    gate is low if its echo frequency (>= echo_dbz) is below block_ratio
+    times the median over azimuths at that range, where that median is at
+    least 0.1. A radial is blocked from the first run of block_run
+    consecutive low gates, so a single noisy or filtered gate does not mask
+    the rest of the radial.
+
+    Parameters
+    ----------
+    sources : list of str
+        HSR files and tar bundles of one site
+    workers : int
+        number of decoding threads
+    rain_dbz, clear_frac : float
+        selection of clear-air scans
+    clutter_dbz, clutter_freq : float
+        clutter gates
+    echo_dbz, block_ratio : float
+        low gates
+    block_run : int
+        least number of consecutive low gates of a blockage
+    min_scans : int
+        least number of clear-air scans
+
+    Returns
+    -------
+    mask : 2D bool array (azimuth, range)
+        True for clutter or blocked gates
+    meta : ScanMeta
+        geometry of the site
+    """
+    nscan, n_clutter, n_echo, meta = 0, None, None, None
+    for dbz, m in hsr_archive(sources, workers=workers, dtype='float32'):
+        if meta is None:
+            meta = m
+            n_clutter = np.zeros(dbz.shape, dtype='i4')
+            n_echo = np.zeros(dbz.shape, dtype='i4')
+        if dbz.shape != n_clutter.shape:
+            print(f'skip {m.time}: geometry {dbz.shape} differs from {n_clutter.shape}')
+            continue
+        if (dbz >= rain_dbz).mean() >= clear_frac:  # 降水扫描
+            continue
+        n_clutter += dbz >= clutter_dbz
+        n_echo += dbz >= echo_dbz
+        nscan += 1
+    if nscan < min_scans:
+        raise ValueError(f'not enough clear-air scans={nscan}(>={min_scans})')
+    print(f'{nscan} clear-air scans')
+
+    mask = n_clutter > clutter_freq * nscan
+    freq = n_echo / nscan
+    ref = np.median(freq, axis=0)
+    low = (freq < block_ratio * ref[np.newaxis, :]) & (ref[np.newaxis, :] >= 0.1)
+    # 从block_run个连续低值库开始遮挡之后的整段径向
+    n = np.concatenate([np.zeros((len(low), 1), 'i4'), np.cumsum(low, axis=1, dtype='i4')], axis=1)
+    run = (n[:, block_run:] - n[:, :-block_run]) == block_run  # 以各库开始的连续低值
+    first = np.where(run.any(axis=1), run.argmax(axis=1), low.shape[1])
+    blocked = np.arange(low.shape[1])[np.newaxis, :] >= first[:, np.newaxis]
+    return mask | blocked, meta
+
+
+def save_mask(fp, mask, meta):
+    """store a polar mask as packed bits with its site geometry"""
+    tmp = f'{fp}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(tmp, bits=np.packbits(mask), shape=np.array(mask.shape),
+                        azimuth=meta.azimuth, range=meta.range,
+                        site=np.array([meta.lon, meta.lat, meta.alt]))
+    os.replace(tmp, fp)
+
+
+class SiteMask:
+    """static polar mask of a site with the geometry it was derived on"""
+
+    __slots__ = ('mask', 'key', 'azimuth', 'range', 'site')
+
+    def __init__(self, mask, key, azimuth, range, site):
+        self.mask, self.key = mask, key
+        self.azimuth, self.range, self.site = azimuth, range, site
+
+    def matches(self, meta):
+        """whether the mask applies to a scan of geometry meta (ScanMeta)"""
+        return (np.array_equal(self.azimuth, meta.azimuth)
+                and np.array_equal(self.range, meta.range)
+                and np.allclose(self.site, [meta.lon, meta.lat, meta.alt], atol=1e-3))
+
+
+def load_mask(fp):
+    """polar mask stored by save_mask, kept in memory until the file changes
+
+    Returns
+    -------
+    SiteMask
+        the mask, its hash (part of the remapped scans cache key) and the
+        site geometry
+    """
+    stamp = os.stat(fp).st_mtime_ns
+    if fp not in _MASKS or _MASKS[fp][0] != stamp:
+        f = np.load(fp)
+        shape = tuple(f['shape'])
+        mask = np.unpackbits(f['bits'], count=shape[0] * shape[1]).reshape(shape).astype(bool)
+        _MASKS[fp] = (stamp, SiteMask(mask, hashlib.sha1(f['bits'].tobytes()).hexdigest()[:16],
+                                      f['azimuth'], f['range'], f['site']))
+    return _MASKS[fp][1]
+
+
+def site_mask(params):
+    """mask of the site configured by params ('maskDir', 'stationId'), None if absent"""
+    if params.get('maskDir'):
+        fp = os.path.join(params['maskDir'], f"{params.get('stationId', 'Z9280')}_mask.npz")
+        if os.path.exists(fp):
+            return load_mask(fp)
+    return None
@@ -1,10 +1,15 @@
 import numpy as np
 import pandas as pd
 import xarray as xr
-from ywqpe import calib
-from ywqpe.io import hsr_decode
+from datetime import timedelta
+from ywqpe import calib, clutter
+from ywqpe.cache import ScanCache
+from ywqpe.io import hsr_read, scan_time
 from ywqpe.remap import to_enu, xy2ll
 
+_VALID_INDEX = {}
+_PACKED_XY = {}
+
 
 def _to_rain(dbz, A, b):
     """convert dBZ to rainrate
@@ -53,7 +58,194 @@ def _stn_proc(df):
                         'lat': lats, 'rain': pre_1h})
 
 
-def hybrid_proc(fp, grid_reso=1e3):
+class Grid:
+    """radar-centred cartesian grid of remapped scans and products"""
+
+    __slots__ = ('center_lon', 'center_lat', 'center_alt', 'max_rng', 'grid_reso',
+                 'longitude', 'latitude')
+
+    def __init__(self, center_lon, center_lat, center_alt, max_rng, grid_reso):
+        self.center_lon, self.center_lat, self.center_alt = center_lon, center_lat, center_alt
+        self.max_rng, self.grid_reso = max_rng, grid_reso
+        x = np.arange(-max_rng, max_rng + grid_reso / 2, grid_reso)
+        lon, lat = xy2ll(x / 1e3, x / 1e3, center_lon, center_lat)
+        self.longitude, self.latitude = lon.astype('float32'), lat.astype('float32')
+
+    @property
+    def attrs(self):
+        return {'center_lon': self.center_lon, 'center_lat': self.center_lat,
+                'center_alt': self.center_alt, 'max_rng': self.max_rng,
+                'grid_reso': self.grid_reso}
+
+    @property
+    def index(self):
+        """flat indices of the pixels a packed field keeps
+
+        Pixels farther than max_rng plus the Cressman radius are NaN for
+        every remap method. The index only depends on max_rng and grid_reso,
+        so it is computed once per site geometry.
+        """
+        key = (self.max_rng, self.grid_reso)
+        if key not in _VALID_INDEX:
+            x = np.arange(-self.max_rng, self.max_rng + self.grid_reso / 2, self.grid_reso)
+            rr = np.hypot(x[np.newaxis, :], x[:, np.newaxis])
+            _VALID_INDEX[key] = np.flatnonzero(rr < self.max_rng + 1.5 * self.grid_reso)
+        return _VALID_INDEX[key]
+
+    def packed_xy(self, dtype='float64'):
+        """cartesian coordinates (1 x n, meters) of the pixels a packed field
+        keeps, computed once per (max_rng, grid_reso, dtype)"""
+        key = (self.max_rng, self.grid_reso, np.dtype(dtype).str)
+        if key not in _PACKED_XY:
+            x = np.arange(-self.max_rng, self.max_rng + self.grid_reso / 2, self.grid_reso).astype(dtype)
+            row, col = np.divmod(self.index, len(x))
+            _PACKED_XY[key] = x[np.newaxis, col], x[np.newaxis, row]
+        return _PACKED_XY[key]
+
+    def unpack(self, packed):
+        """expand a packed field (1D, see index) to the grid, NaN out of range"""
+        out = np.full(len(self.latitude) * len(self.longitude), np.nan,
+                      dtype=np.result_type(packed, np.float32))
+        out[self.index] = packed
+        return out.reshape(len(self.latitude), len(self.longitude))
+
+
+def _enu_dataset(dbz, grid):
+    """wrap a remapped dBZ field with the radar-centred grid coordinates
+
+    Parameters
+    ----------
+    dbz : 2D array
+        dBZ in the cartesian coordinate
+    grid : Grid
+
+    Returns
+    -------
+    2D xr.Dataset
+        contains variable 'dbz' with coordinates('lat', 'lon')
+    """
+    return xr.Dataset(data_vars={'dbz': (['latitude', 'longitude'], dbz)},
+                      coords={'longitude': ('longitude', grid.longitude),
+                              'latitude': ('latitude', grid.latitude)},
+                      attrs={'center_lon': grid.center_lon, 'center_lat': grid.center_lat,
+                             'center_alt': grid.center_alt})
+
+
+def remap_scan(fp, grid_resos, cache=None, method='sprint', packed=False, dtype='float64',
+               mask=None):
+    """decode a hybrid scan radar file once and remap it onto several grids
+
+    Parameters
+    ----------
+    fp : str
+        radar file path
+    grid_resos : list of float
+        grid resolutions in meters
+    cache : ywqpe.cache.ScanCache
+        remapped scans cache, checked before decoding
+    method : str
+        remap method of to_enu: 'sprint' (bilinear), 'nearest' or 'reorder'
+        (Cressman with a radius of one grid cell)
+    packed : bool
+        only remap the pixels in range and return them as a 1D array (see
+        Grid.index and Grid.unpack); 'reorder' remaps the whole grid by rows
+        and is packed afterwards, so it saves memory but no remap time
+    dtype : str
+        float type of the decoded scan, the grid coordinates of 'sprint' and
+        the values the remap kernels work on; the 'reorder' gate bins and
+        the 'nearest' index are computed once per geometry in float64.
+        'float32' halves the memory of the values, the remapped dBZ differs
+        from 'float64' by at most 3e-5 of the dBZ step between neighbouring
+        gates (< 3e-3 dBZ), i.e. < 5e-4 relative error of the rain rate
+    mask : clutter.SiteMask
+        static clutter / blockage polar mask of the site (see
+        clutter.load_mask), only applied to scans of the same geometry
+
+    Returns
+    -------
+    list of (2D float32 array, Grid)
+        dBZ in the cartesian coordinate of every grid resolution, 1D if packed
+    """
+
+    out = [None] * len(grid_resos)
+    keys = [None] * len(grid_resos)
+    if cache is not None:
+        content = cache.content(fp)  # 文件只读取、哈希一次
+        for i, grid_reso in enumerate(grid_resos):
+            extra = {'packed': True} if packed else {}
+            if dtype != 'float64':
+                extra['dtype'] = dtype
+            if mask is not None:
+                extra['mask'] = mask.key
+            keys[i] = cache.key(fp, content=content, grid_reso=grid_reso, method=method,
+                                beam_width=1., **extra)
+            hit = cache.load(keys[i])
+            if hit is not None:
+                out[i] = (hit[0], Grid(**hit[1]))
+    if all(r is not None for r in out):
+        return out
+
+    todo = [i for i, r in enumerate(out) if r is None]
+    dbz, meta = hsr_read(fp, dtype=dtype)
+    enus = remap_polar(dbz, meta, [grid_resos[i] for i in todo], method=method,
+                       packed=packed, dtype=dtype, mask=mask)
+    for i, (enu, grid) in zip(todo, enus):
+        if cache is not None:
+            cache.save(keys[i], enu, grid.attrs)
+        out[i] = (enu, grid)
+    return out
+
+
+def remap_polar(dbz, meta, grid_resos, method='sprint', packed=False, dtype='float64',
+                mask=None):
+    """remap a decoded scan (see io.hsr_read, io.hsr_archive) onto several grids
+
+    Parameters
+    ----------
+    dbz : 2D array (azimuth, range)
+        reflectivity, -33 for missing
+    meta : ywqpe.io.ScanMeta
+    grid_resos, method, packed, dtype :
+        see remap_scan
+    mask : clutter.SiteMask
+        gates to drop, only applied if its site and geometry match meta
+
+    Returns
+    -------
+    list of (2D float32 array, Grid)
+        dBZ in the cartesian coordinate of every grid resolution, 1D if packed
+    """
+    if mask is not None and not mask.matches(meta):
+        print(f'clutter mask of another site or geometry, not applied to {meta.time}')
+        mask = None
+    if mask is None:
+        dbz = np.where(dbz != -33., dbz, np.nan) # 缺测值处理
+    else:  # 缺测值和静态杂波、遮挡一起处理
+        dbz = np.where((dbz != -33.) & ~mask.mask, dbz, np.nan)
+    rng = meta.range
+    max_rng = rng[-1]
+    out = []
+    for grid_reso in grid_resos:
+        grid_reso = grid_reso or (rng[-1] - rng[0])
+        grid = Grid(meta.lon, meta.lat, meta.alt, float(max_rng), float(grid_reso))
+        if packed and method != 'reorder':  # 只计算范围内的像素（1行n列）
+            xx, yy = grid.packed_xy(dtype)
+        else:
+            x = np.arange(-max_rng, max_rng + grid_reso / 2, grid_reso).astype(dtype)
+            xx, yy = np.meshgrid(x, x)
+        radius = {'x_r': grid_reso, 'y_r': grid_reso} if method == 'reorder' else {}
+        # xx、yy由格点参数确定，最近邻索引按格点参数缓存
+        geometry = (grid.max_rng, grid.grid_reso, packed, dtype)
+        enu = to_enu(xx, yy, dbz, meta.azimuth, meta.elevation, rng,
+                     method=method, beam_width=1., geometry=geometry, **radius)
+        enu = enu.astype('float32')
+        if packed:
+            enu = enu.ravel()[grid.index] if method == 'reorder' else enu.ravel()
+        out.append((enu, grid))
+    return out
+
+
+def hybrid_proc(fp, grid_reso=1e3, cache=None, method='sprint'):
     """read hybrid scan radar dBZ
 
     Parameters
@@ -62,34 +254,49 @@ def hybrid_proc(fp, grid_reso=1e3):
         radar file path
     grid_reso : float
         grid resolution in meters
+    cache : ywqpe.cache.ScanCache
+        remapped scans cache, checked before decoding
+    method : str
+        remap method of to_enu: 'sprint' (bilinear), 'nearest' or 'reorder'
+        (Cressman with a radius of one grid cell)
 
     Returns
     -------
     2D xr.Dataset
         contains variable 'dbz' with coordinates('lat', 'lon')
     """
+    return _enu_dataset(*remap_scan(fp, [grid_reso], cache=cache, method=method)[0])
 
-    hsr_dbz = hsr_decode(fp)
-    hsr_dbz = hsr_dbz.where(hsr_dbz.data != -33.) # 缺测值处理
-    rng = hsr_dbz[hsr_dbz.dims[-1]]
-    grid_reso = grid_reso or (rng[-1] - rng[0])
-    max_rng = rng[-1]
-    x = np.arange(-max_rng, max_rng + grid_reso / 2, grid_reso)
-    xx, yy = np.meshgrid(x, x)
-    hsr_enu = to_enu(xx, yy, hsr_dbz.isel(valid_time=0), method='sprint', beam_width=1.)
-
-    lon, lat = xy2ll(xx[0, :] / 1e3, yy[:, 1] / 1e3, hsr_dbz.rad_lon, hsr_dbz.rad_lat)
-    hsr_enu = xr.Dataset(data_vars={'dbz': (['y', 'x'], hsr_enu.astype('float32'))}, 
-                            coords={'x': ('x', xx[0, :]), 'y': ('y', yy[:, 1])},
-                attrs={'center_lon': hsr_dbz.rad_lon, 'center_lat': hsr_dbz.rad_lat, 'center_alt': hsr_dbz.rad_alt})
-    hsr_enu = hsr_enu.assign_coords(coords={'longitude': ('x', lon.astype('float32')), 
-                                            'latitude': ('y', lat.astype('float32'))})
-    hsr_enu = hsr_enu.swap_dims({'x': 'longitude', 'y': 'latitude'})
-    hsr_enu = hsr_enu.drop(['y', 'x'], dim=None)
-    return hsr_enu
-
-
-def qpe(radar_fps, df, params):  
+
+def scan_cache(params):
+    """remapped scans cache configured by params ('cacheDir', 'cacheSize' in GB)"""
+    if params.get('cacheDir'):
+        return ScanCache(params['cacheDir'], max_bytes=int(params.get('cacheSize', 20) * 2 ** 30))
+    return None
+
+
+def stn_accum(df, params):
+    """accumulate gauge observations and drop light rain
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        observations of gauges in the accumulation window
+    params : dict
+        config params for qpe
+
+    Returns
+    -------
+    pd.DataFrame or None
+        accumulated rain of gauges, None if there is no observation
+    """
+    if len(df) == 0:
+        return None
+    df_1h = _stn_proc(df)
+    return df_1h[df_1h['rain'] >= params.get('prec_th', 0.6)]
+
+
+def qpe(radar_fps, df, params, windows=None, grid_resos=None):
     """1h qpe for radar_fps files
 
     Parameters
@@ -100,37 +307,175 @@ def qpe(radar_fps, df, params):
         observations of gauges
     params : dict
         config params for qpe
+    windows : list of int
+        accumulation windows (minutes) ending at the last radar file. If
+        windows or grid_resos is given, all products are computed from one
+        decoding of radar_fps
+    grid_resos : list of float
+        grid resolutions (degrees, same as params['gridReso'])
 
     Returns
     -------
     2D xr.Dataset
         contains variable ('dbz', 'qpe', 'qpe_g', 'qpe_c') with coordinates('lat', 'lon')
+    dict
+        {(window, grid_reso): 2D xr.Dataset} if windows or grid_resos is given
     """
-    ds = xr.concat([hybrid_proc(fp,
-                                grid_reso=(params.get('gridReso') / 0.01) * 1e3,
-                                ) for fp in radar_fps], dim='valid_time')
+    if windows is None and grid_resos is None:
+        cache = scan_cache(params)
+        mask = clutter.site_mask(params)
+        scans = [remap_scan(fp,
+                            [(params.get('gridReso') / 0.01) * 1e3],
+                            cache=cache,
+                            method=params.get('remap', 'sprint'),
+                            packed=params.get('packed', False),
+                            dtype=params.get('dtype', 'float64'),
+                            mask=mask,
+                            )[0] for fp in radar_fps]
+
+        qpe_1h = _to_rain(np.stack([dbz for dbz, _ in scans]), A=params.get('A', 300.), b=params.get('b', 1.4))
+        return qpe_product(scans[0][1], qpe_1h.mean(axis=0), stn_accum(df, params), params)
+    return qpe_multi(radar_fps, df, params,
+                     windows=windows or [params.get('timeReso', 60)],
+                     grid_resos=grid_resos or [params.get('gridReso')])
+
+
+def qpe_multi(radar_fps, df, params, windows, grid_resos):
+    """qpe products of several windows and grids from one ingest pass
+
+    Every radar file is decoded once and remapped once per grid. Scans are
+    summed from the newest backwards, so the sum of each window is a prefix
+    of the same running sum (nested windows). Gauges are aggregated once per
+    window and shared by all grids.
+
+    Parameters
+    ----------
+    radar_fps : list of str
+        radar files path covering the longest window
+    df : pd.DataFrame
+        observations of gauges covering the longest window
+    params : dict
+        config params for qpe
+    windows : list of int
+        accumulation windows (minutes) ending at the last radar file
+    grid_resos : list of float
+        grid resolutions (degrees)
 
-    qpe_1h = _to_rain(ds.dbz.data, A=params.get('A', 300.), b=params.get('b', 1.4))
-    ds['qpe'] = (('latitude', 'longitude'), qpe_1h.mean(axis=0))
-    ds['qpe'].values = np.where(ds.qpe != 0., ds.qpe.values, np.nan)
+    Returns
+    -------
+    dict
+        {(window, grid_reso): 2D xr.Dataset}, windows without radar files
+        are skipped
+    """
+    radar_fps = sorted(radar_fps, key=scan_time)
+    times = [scan_time(fp) for fp in radar_fps]
+    t_ref = times[-1]
+    cache = scan_cache(params)
+    mask = clutter.site_mask(params)
+
+    # 每个窗口包含的文件数（按时间倒序的前n个文件）
+    nscan = {w: sum(t > t_ref - timedelta(minutes=w) for t in times) for w in windows}
+    for w in windows:
+        if nscan[w] == 0:
+            print(f'no radar files in the {w}min window, skipped')
+    df_acc = {}
+    for w in windows:
+        if len(df) > 0:
+            df_w = df[(df['Datetime'] > t_ref - timedelta(minutes=w)) & (df['Datetime'] <= t_ref)]
+        else:
+            df_w = df
+        df_acc[w] = stn_accum(df_w, params)
+
+    sums = [None] * len(grid_resos)
+    qpe_w = {}
+    for k, fp in enumerate(radar_fps[::-1]):
+        enus = remap_scan(fp, [(g / 0.01) * 1e3 for g in grid_resos], cache=cache,
+                          method=params.get('remap', 'sprint'),
+                          packed=params.get('packed', False),
+                          dtype=params.get('dtype', 'float64'), mask=mask)
+        for i, (dbz, grid) in enumerate(enus):
+            rain = _to_rain(dbz, A=params.get('A', 300.), b=params.get('b', 1.4))
+            sums[i] = rain if sums[i] is None else sums[i] + rain
+            for w in windows:
+                if nscan[w] == k + 1:
+                    qpe_w[(w, i)] = (grid, sums[i] / nscan[w])
+
+    products = {}
+    for (w, i), (grid, qpe_mean) in qpe_w.items():
+        print(f'processing {w}min qpe on {grid_resos[i]} grid')
+        df_w = df_acc[w] if df_acc[w] is None else df_acc[w].copy()
+        products[(w, grid_resos[i])] = qpe_product(grid, qpe_mean, df_w, params)
+    return products
+
+
+def calibrate_qpe(qpe, grid, df_acc, params):
+    """calibrate an accumulated radar qpe with gauges
+
+    Parameters
+    ----------
+    qpe : 2D array
+        mean rain rate of the accumulation window, or 1D if packed (see
+        Grid.index)
+    grid : Grid
+    df_acc : pd.DataFrame or None
+        accumulated rain of gauges (see stn_accum)
+    params : dict
+        config params for qpe
+
+    Returns
+    -------
+    dict
+        arrays 'qpe' and, if enough gauges, 'qpe_oi' of the same shape as qpe
+    """
+    qpe = np.where(qpe != 0., qpe, np.nan)
+    index = grid.index if qpe.ndim == 1 else None
+    products = {'qpe': qpe}
 
     # 自动站数据读取、处理
-    if len(df) > 0:  # 获取到自动站观测数据
+    if df_acc is not None:  # 获取到自动站观测数据
         # df = pd.read_csv(stn_file, usecols=['PRE', 'Lon', 'Station_Id_C', 'Lat', 'Datetime'], 
         #                     na_values=[999998.0, 999999.0])
-        df_1h = _stn_proc(df)
-        df_1h = df_1h[df_1h['rain'] >= params.get('prec_th', 0.6)]
+        df_1h = df_acc
         if len(df_1h) > params.get('stn_num', 30):
             global calibrate  # 利用全局平均订正因子进行初步降水订正
-            ds['qpe_g'] = calib.global_calibrate(ds.qpe, df_1h,
-                                                K_min=params.get('K_min', 0.5),
-                                                K_max=params.get('K_max', 2.))
+            K = calib.global_factor(qpe, grid.longitude, grid.latitude, df_1h,
+                                    K_min=params.get('K_min', 0.5),
+                                    K_max=params.get('K_max', 2.), index=index)
+            qpe_g = K * qpe
+            if params.get('dtype', 'float64') != 'float64':  # K为float64，避免提升精度
+                qpe_g = qpe_g.astype(params['dtype'])
 
             # local calibrate # 利用分析格点搜索范围内(dis=0.2~20km)的自动站点进行分析格点降水订正
-            qpe_oi = calib.oi(ds.qpe_g, df_1h, a=0.2, dis=params.get('dis', 0.2))
-            ds['qpe_oi'] = (('latitude', 'longitude'), qpe_oi)
+            products['qpe_oi'] = calib.oi_array(qpe_g, grid.longitude, grid.latitude, df_1h,
+                                                a=params.get('a', 0.2), dis=params.get('dis', 0.2),
+                                                op_dir=params.get('oiDir'), index=index)
         else:
             print(f"not enough gauge={len(df_1h)}(>{params.get('stn_num', 30)})")
+    return products
+
+
+def to_dataset(products, grid, params):
+    """build the output product from plain arrays
+
+    Parameters
+    ----------
+    products : dict
+        arrays returned by calibrate_qpe, packed ones are expanded to the grid
+    grid : Grid
+    params : dict
+        config params for qpe
+
+    Returns
+    -------
+    2D xr.Dataset
+        contains variable ('qpe', 'qpe_oi') with coordinates('lat', 'lon')
+    """
+    products = {k: grid.unpack(v) if v.ndim == 1 else v for k, v in products.items()}
+    ds = xr.Dataset(data_vars={k: (('latitude', 'longitude'), v) for k, v in products.items()},
+                    coords={'longitude': ('longitude', grid.longitude),
+                            'latitude': ('latitude', grid.latitude)},
+                    attrs={'center_lon': grid.center_lon, 'center_lat': grid.center_lat,
+                           'center_alt': grid.center_alt})
     ds.attrs['longitude_min'] = np.around(ds.longitude.values[0], 3)
     ds.attrs['longitude_max'] = np.around(ds.longitude.values[-1], 3)
     ds.attrs['latitude_min'] = np.around(ds.latitude.values[0], 3)
@@ -142,3 +487,25 @@ def qpe(radar_fps, df, params):
     else:
         ds_temp = ds['qpe']
     return ds_temp
+
+
+def qpe_product(grid, qpe, df_acc, params):
+    """calibrate an accumulated radar qpe with gauges
+
+    Parameters
+    ----------
+    grid : Grid
+        grid of the radar qpe
+    qpe : 2D array
+        mean rain rate of the accumulation window, or 1D if packed
+    df_acc : pd.DataFrame or None
+        accumulated rain of gauges (see stn_accum)
+    params : dict
+        config params for qpe
+
+    Returns
+    -------
+    2D xr.Dataset
+        contains variable ('qpe', 'qpe_oi') with coordinates('lat', 'lon')
+    """
+    return to_dataset(calibrate_qpe(qpe, grid, df_acc, params), grid, params)
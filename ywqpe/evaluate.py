@@ -0,0 +1,223 @@
+import itertools
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from scipy.linalg import cho_factor, cho_solve
+from scipy.spatial import cKDTree
+from ywqpe import clutter, core, reproc
+from ywqpe.calib import _corners
+from ywqpe.io import hsr_archive
+from ywqpe.oi_core import rcoef
+
+_SAMPLES = None
+
+
+def sample_archive(rad_dir, stn_dir, start, end, params, window=60, step=60, io_workers=2):
+    """decode an archive once and sample it at the gauges
+
+    Every scan is decoded once by io.hsr_archive (rad_dir may hold tar
+    bundles) and only the dBZ of the 4 grid cells around each gauge is kept,
+    which is all that the global calibration and the OI at gauge locations
+    need for any A, b, K and OI parameters.
+
+    Parameters
+    ----------
+    rad_dir, stn_dir : str
+        directories of HSR files (or tar bundles of them) and gauge csv files
+    start, end : datetime
+        time range [start, end) of the evaluated windows
+    params : dict
+        config params for qpe (gridReso, remap, dtype, maskDir)
+    window : int
+        accumulation window (minutes)
+    step : int
+        least interval (minutes) between evaluated windows
+    io_workers : int
+        number of decoding threads
+
+    Returns
+    -------
+    dict
+        'dbz' (nscan, nstn, 4), 'wts' (nstn, 4), 'pts' (nstn, 2) and 'cases',
+        a list of (scan indices, gauge indices, accumulated rain)
+    """
+    lead = timedelta(minutes=window)
+    fps = reproc.scan_index(rad_dir)
+    fps = fps[(fps.index > start - lead) & (fps.index < end)]
+    df = reproc.gauge_read(stn_dir, start - lead, end)
+    stations = df.groupby('Station_Id_c')[['Lon', 'Lat']].first()
+    stn_pos = {s: i for i, s in enumerate(stations.index)}
+    pts = stations.values.astype('f8')
+
+    grid_reso = (params.get('gridReso') / 0.01) * 1e3
+    dtype = params.get('dtype', 'float64')
+    mask = clutter.site_mask(params)
+    dbz, idx, wts = [], None, None
+    for polar, meta in hsr_archive(list(fps.values), workers=io_workers, dtype=dtype):
+        enu, grid = core.remap_polar(polar, meta, [grid_reso],
+                                     method=params.get('remap', 'sprint'), dtype=dtype,
+                                     mask=mask)[0]
+        if idx is None:
+            idx, wts = _corners(grid.longitude, grid.latitude, pts)
+        dbz.append(np.asarray(enu).ravel()[idx])
+
+    times = fps.index.to_pydatetime()
+    cases, last = [], None
+    for k, t in enumerate(times):
+        if t < start or (last is not None and t - last < timedelta(minutes=step)):
+            continue
+        scans = np.flatnonzero((times > t - lead) & (times <= t))
+        if len(scans) < reproc.min_scans(window, params.get('scanReso', 6.)):
+            continue
+        stn = core._stn_proc(df[(df.Datetime > t - lead) & (df.Datetime <= t)])
+        if len(stn) == 0:
+            continue
+        cases.append((scans, np.array([stn_pos[s] for s in stn['Station_Id_c']]), stn['rain'].values))
+        last = t
+    print(f'{len(times)} scans, {len(pts)} gauges, {len(cases)} windows sampled')
+    return {'dbz': np.array(dbz, dtype='float32'), 'wts': wts, 'pts': pts, 'cases': cases}
+
+
+def oi_loo(pts, d, members, a, dis, choice, min_pts=5):
+    """OI increments at gauges, leave-one-out for the calibration gauges
+
+    Gauges are grouped by the calibration gauges within dis; each group's
+    kernel matrix K is factorized once. Removing gauge g from the group is a
+    rank-one downdate of K^-1 = P, which gives the leave-one-out increment
+    in closed form: d_g - (P d)_g / P_gg.
+
+    Parameters
+    ----------
+    pts : (N, 2) array
+        lon, lat of gauges
+    d : 1D array
+        rain - Rb of gauges (only used for members)
+    members : 1D bool array
+        gauges used by the calibration
+    a, dis, choice : float, float, int
+        OI parameters as in oi_calib
+
+    Returns
+    -------
+    1D array
+        OI increment at every gauge
+    """
+    inc = np.zeros(len(pts))
+    im = np.flatnonzero(members)
+    if len(im) <= min_pts:
+        return inc
+    near = cKDTree(pts[im]).query_ball_point(pts, dis)
+
+    groups = {}
+    for g in range(len(pts)):
+        sel = np.array(sorted(k for k in near[g]
+                              if np.sqrt(((pts[im[k]] - pts[g]) ** 2.).sum()) < dis), dtype='i8')
+        groups.setdefault(sel.tobytes(), (sel, []))[1].append(g)
+
+    for sel, gs in groups.values():
+        S = im[sel]
+        p = pts[S]
+        R_kl = np.sqrt(((p[:, np.newaxis, :] - p[np.newaxis, :, :]) ** 2.).sum(axis=-1))
+        fac = cho_factor(rcoef(R_kl, a, choice) + np.eye(len(S)) * 0.01)
+        Pd = cho_solve(fac, d[S])
+        loo = [g for g in gs if members[g]]
+        full = [g for g in gs if not members[g]]
+        if len(loo) > 0 and len(S) - 1 > min_pts:
+            P = cho_solve(fac, np.eye(len(S)))
+            k = np.searchsorted(S, loo)
+            inc[loo] = d[loo] - Pd[k] / P[k, k]
+        if len(full) > 0 and len(S) > min_pts:
+            R_kj = np.sqrt(((p[:, np.newaxis, :] - pts[full][np.newaxis, :, :]) ** 2.).sum(axis=-1))
+            inc[full] = rcoef(R_kj, a, choice).T @ Pd
+    return inc
+
+
+def _scores(est, obs, th):
+    est = np.where(np.isnan(est), 0., est)
+    hit = ((est >= th) & (obs >= th)).sum()
+    miss = ((est < th) & (obs >= th)).sum()
+    false = ((est >= th) & (obs < th)).sum()
+    return {'bias': np.mean(est - obs), 'rmse': np.sqrt(np.mean((est - obs) ** 2.)),
+            'csi': hit / max(hit + miss + false, 1)}
+
+
+def evaluate(samples, setting, th=0.1):
+    """scores of qpe, global and LOO OI calibration for one parameter setting
+
+    Parameters
+    ----------
+    samples : dict
+        returned by sample_archive
+    setting : dict
+        config params for qpe (A, b, K_min, K_max, a, dis, prec_th, stn_num)
+    th : float
+        rain threshold of CSI
+
+    Returns
+    -------
+    dict
+        setting with 'bias', 'rmse' and 'csi' of 'qpe', 'qpe_g' and 'qpe_oi'
+    """
+    A, b = setting.get('A', 300.), setting.get('b', 1.4)
+    est = {'qpe': [], 'qpe_g': [], 'qpe_oi': []}
+    obs = []
+    for scans, stn, rain in samples['cases']:
+        qpe = core._to_rain(samples['dbz'][scans][:, stn], A=A, b=b).mean(axis=0)
+        qpe = np.where(qpe != 0., qpe, np.nan)  # 与core.qpe_product一致，无降水格点为NaN
+        Rq = (qpe * samples['wts'][stn]).sum(axis=-1)
+
+        cal = (rain >= setting.get('prec_th', 0.6)) & ~np.isnan(Rq)
+        Rb, Ra = Rq, Rq
+        if cal.sum() > setting.get('stn_num', 30):
+            K = np.clip(rain[cal].sum() / Rq[cal].sum(), setting.get('K_min', 0.5), setting.get('K_max', 2.))
+            Rb = K * Rq
+            Ra = Rb + oi_loo(samples['pts'][stn], rain - Rb, cal, setting.get('a', 0.2),
+                             setting.get('dis', 0.2), setting.get('choice', 0))
+        est['qpe'].append(Rq)
+        est['qpe_g'].append(Rb)
+        est['qpe_oi'].append(Ra)
+        obs.append(rain)
+
+    obs = np.concatenate(obs) if len(obs) > 0 else np.zeros(0)
+    out = dict(setting, n=len(obs))
+    for name, v in est.items():
+        v = np.concatenate(v) if len(v) > 0 else np.zeros(0)
+        for score, value in _scores(v, obs, th).items():
+            out[f'{name}_{score}'] = value
+    return out
+
+
+def _init(samples):
+    global _SAMPLES
+    _SAMPLES = samples
+
+
+def _evaluate(setting):
+    return evaluate(_SAMPLES, setting)
+
+
+def sweep(samples, grid, params, workers=1):
+    """evaluate every combination of a parameter grid in parallel
+
+    Parameters
+    ----------
+    samples : dict
+        returned by sample_archive
+    grid : dict
+        {param name: list of values}, e.g. {'A': [200, 300], 'dis': [0.1, 0.2]}
+    params : dict
+        config params for qpe, default of the parameters not in grid
+    workers : int
+        number of worker processes
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per setting
+    """
+    names = list(grid)
+    settings = [dict(params, **dict(zip(names, v))) for v in itertools.product(*grid.values())]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(samples,)) as pool:
+        rows = list(pool.map(_evaluate, settings))
+    return pd.DataFrame(rows)
@@ -1,56 +1,237 @@
 import os
 import struct
+import tarfile
+import threading
 import numpy as np
+import pandas as pd
 import xarray as xr
-from pyzstd import ZstdFile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pyzstd import decompress
 from datetime import datetime
 
 
-def hsr_decode(fp):
-    if fp.endswith('.zst'):
-        f = ZstdFile(fp)
-    else:
-        f = open(fp, 'rb')
+def scan_time(fp):
+    """observation time of a HSR file parsed from its name
 
-    # 文件头
-    _ = f.read(142) # 地址参数
-    lon, lat, alt = struct.unpack('3i', f.read(12))
+    Parameters
+    ----------
+    fp : str
+        radar file path named as 'YW_RADA_*_*_%Y%m%d%H%M%S_*'
+
+    Returns
+    -------
+    datetime
+    """
+    return datetime.strptime(os.path.split(fp)[1].split('_')[4], "%Y%m%d%H%M%S")
+
+
+def stn_read(fp):
+    """read minutes observations of gauges from a csv file
+
+    Parameters
+    ----------
+    fp : str
+        gauge file path with columns ('PRE', 'Lon', 'Station_Id_C', 'Lat', 'Datetime')
+
+    Returns
+    -------
+    pd.DataFrame
+        columns=['Datetime', 'Station_Id_c', 'Lon', 'Lat', 'rain']
+    """
+    df = pd.read_csv(fp, usecols=['PRE', 'Lon', 'Station_Id_C', 'Lat', 'Datetime'],
+                     na_values=[999998.0, 999999.0], parse_dates=['Datetime'])
+    df = df.rename(columns={'PRE': 'rain', 'Station_Id_C': 'Station_Id_c'})
+    return df[['Datetime', 'Station_Id_c', 'Lon', 'Lat', 'rain']]
+
+
+class ScanMeta:
+    """site, time and polar geometry of a radar scan"""
+
+    __slots__ = ('time', 'lon', 'lat', 'alt', 'azimuth', 'elevation', 'range')
+
+    def __init__(self, time, lon, lat, alt, azimuth, elevation, range):
+        self.time = time
+        self.lon, self.lat, self.alt = lon, lat, alt
+        self.azimuth, self.elevation, self.range = azimuth, elevation, range
+
+
+_HEADER = 1266  # 文件头字节数
+_RADIAL_HEADER = 64  # 径向头字节数
+TAR_EXT = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+_BUFFERS = threading.local()
+
+
+def hsr_parse(buf, time, dtype='float64'):
+    """decode a hybrid scan radar file held in memory
+
+    Parameters
+    ----------
+    buf : bytes-like
+        uncompressed file content
+    time : datetime
+        observation time of the scan
+    dtype : str
+        float type of dbz, dbz is exact in float32 (0.5 dBZ steps)
+
+    Returns
+    -------
+    dbz : 2D array (azimuth, range)
+        reflectivity, -33 for missing
+    meta : ScanMeta
+    """
+    # 文件头：地址参数(142)，经纬度高度(12)，保留(6)，性能参数(40)，观测参数(446+300+320)
+    lon, lat, alt = struct.unpack_from('3i', buf, 142)
     lon, lat, alt = lon / 3.6 / 1e5, lat / 3.6 / 1e5, alt / 1e3
-    _ = f.read(6)
-    
-    perf_bits = f.read(40) # 性能参数
-
-    ## 观测参数
-    _ = f.read(446)
-    rng_num = struct.unpack('30H', f.read(60))[0] # 各层的反射率距离库数
-    azi_num = struct.unpack('30H', f.read(60))[0] # 各层采样的径向数
-    _ = f.read(60)
-    rng_len = struct.unpack('30H', f.read(60))[0] # 各层反射率库长
-    rng_fr = struct.unpack('30H', f.read(60))[0] # 各层径向上的第一个距离库的开始距离
-    _ = f.read(320)
-
-    # 产品数据
-    refdt = os.path.split(fp)[1].split('.')[0]
-    dbz = np.zeros((azi_num, rng_num), dtype='u1')
+    rng_num = struct.unpack_from('H', buf, 646)[0] # 各层的反射率距离库数
+    azi_num = struct.unpack_from('H', buf, 706)[0] # 各层采样的径向数
+    rng_len = struct.unpack_from('H', buf, 826)[0] # 各层反射率库长
+
     azimuth = np.array(np.arange(0, 360, 360 / azi_num), dtype='f8')
     elevation = np.array(np.ones_like(azimuth) * 0.5, dtype='f8')
     rng = np.array(np.arange(rng_len, rng_num * rng_len + 1, rng_len), dtype='f8')
-    time = np.array(np.arange(0, azi_num), dtype=np.float64)
-
-    for iazi in range(0, azi_num):
-        time[iazi] = iazi
-        _ = f.read(64) # 读取当前径向的径向头数据
-        data_buf = struct.unpack(str(rng_num)+'B', f.read(rng_num))  # 读取当前径向的径向数据
-        for irng in range(0, rng_num):
-            dbz[iazi, irng] = data_buf[irng]
-
-    hybrid_dbz = xr.DataArray(dbz / 2 - 33, dims=('time', 'range'), name='dBZ',
-                     coords=[('time', time), ('range', rng)])
-    t = datetime.strptime(os.path.split(fp)[1].split('_')[4], "%Y%m%d%H%M%S")
-    hybrid_dbz = hybrid_dbz.expand_dims(valid_time=[t], axis=0)
-    hybrid_dbz.coords['azimuth'] = (('time'), azimuth)
-    hybrid_dbz.coords['elevation'] = (('time'), elevation)
-    hybrid_dbz.attrs['rad_lon'] = lon
-    hybrid_dbz.attrs['rad_lat'] = lat
-    hybrid_dbz.attrs['rad_alt'] = alt
+
+    # 产品数据：每个径向为径向头+各距离库数据，一次取出所有径向
+    radials = np.frombuffer(buf, dtype='u1', count=azi_num * (_RADIAL_HEADER + rng_num),
+                            offset=_HEADER).reshape(azi_num, _RADIAL_HEADER + rng_num)
+    dbz = radials[:, _RADIAL_HEADER:].astype(dtype) / 2 - 33
+    return dbz, ScanMeta(time, lon, lat, alt, azimuth, elevation, rng)
+
+
+def _read_into(fp):
+    """file content read into a buffer reused by the calling thread"""
+    size = os.path.getsize(fp)
+    buf = getattr(_BUFFERS, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _BUFFERS.buf = bytearray(max(size, 1 << 20))
+    view = memoryview(buf)[:size]
+    with open(fp, 'rb') as f:
+        f.readinto(view)
+    return view
+
+
+def _decode(data, name, time, dtype):
+    if name.endswith('.zst'):
+        data = decompress(data)  # 整个文件一次解压，解压时释放GIL
+    return hsr_parse(data, time, dtype=dtype)
+
+
+def hsr_read(fp, dtype='float64'):
+    """read a hybrid scan radar file into a plain array
+
+    Parameters
+    ----------
+    fp : str
+        radar file path
+    dtype : str
+        float type of dbz, dbz is exact in float32 (0.5 dBZ steps)
+
+    Returns
+    -------
+    dbz : 2D array (azimuth, range)
+        reflectivity, -33 for missing
+    meta : ScanMeta
+    """
+    with open(fp, 'rb') as f:
+        data = f.read()
+    return _decode(data, fp, scan_time(fp), dtype)
+
+
+def tar_members(fp):
+    """paths '<bundle>/<member>' of the files in a tar bundle (see hsr_archive)"""
+    with tarfile.open(fp) as tf:
+        return [os.path.join(fp, m.name) for m in tf.getmembers() if m.isfile()]
+
+
+def _bundle_of(src):
+    """tar bundle containing a member path '<bundle>/<member>', None for plain files"""
+    head = src
+    while True:
+        head, tail = os.path.split(head)
+        if not tail:
+            return None
+        if head.endswith(TAR_EXT) and os.path.isfile(head):
+            return head
+
+
+def hsr_archive(sources, workers=4, dtype='float64', prefetch=None):
+    """decode many HSR files and tar bundles of HSR files in time order
+
+    Tar members are read without extracting them to disk. Files are read
+    into per-thread buffers, decompressed as a whole and decoded by a thread
+    pool; at most prefetch scans are in flight ahead of the consumer.
+
+    Parameters
+    ----------
+    sources : list of str
+        HSR files ('.zst' or uncompressed), tar bundles of them, and members
+        of tar bundles as '<bundle>/<member>' (see tar_members)
+    workers : int
+        number of decoding threads
+    dtype : str
+        float type of dbz
+    prefetch : int
+        number of scans decoded ahead, 2 * workers if None
+
+    Yields
+    ------
+    dbz : 2D array (azimuth, range)
+        reflectivity, -33 for missing
+    meta : ScanMeta
+    """
+    items = []
+    bundles = {}
+
+    def bundle(fp):
+        if fp not in bundles:
+            tf = tarfile.open(fp)
+            bundles[fp] = (tf, {m.name: m for m in tf.getmembers() if m.isfile()})
+        return bundles[fp]
+
+    try:
+        for src in sources:
+            if src.endswith(TAR_EXT):
+                for m in bundle(src)[1].values():
+                    try:
+                        items.append((scan_time(m.name), src, m))
+                    except (IndexError, ValueError):  # 非雷达文件
+                        continue
+                continue
+            fp = _bundle_of(src)
+            if fp is None:
+                items.append((scan_time(src), src, None))
+            else:
+                items.append((scan_time(src), fp, bundle(fp)[1][src[len(fp) + 1:]]))
+        items.sort(key=lambda item: item[0])
+
+        prefetch = prefetch or 2 * workers
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for t, src, member in items:
+                if member is None:
+                    job = pool.submit(lambda fp, t: _decode(_read_into(fp), fp, t, dtype), src, t)
+                else:  # tarfile不支持多线程读取，在当前线程读出成员
+                    data = bundles[src][0].extractfile(member).read()
+                    job = pool.submit(_decode, data, member.name, t, dtype)
+                pending.append(job)
+                if len(pending) >= prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        for tf, _ in bundles.values():
+            tf.close()
+
+
+def hsr_decode(fp, dtype='float64'):
+    dbz, meta = hsr_read(fp, dtype=dtype)
+    time = np.array(np.arange(0, len(meta.azimuth)), dtype=np.float64)
+    hybrid_dbz = xr.DataArray(dbz, dims=('time', 'range'), name='dBZ',
+                     coords=[('time', time), ('range', meta.range)])
+    hybrid_dbz = hybrid_dbz.expand_dims(valid_time=[meta.time], axis=0)
+    hybrid_dbz.coords['azimuth'] = (('time'), meta.azimuth)
+    hybrid_dbz.coords['elevation'] = (('time'), meta.elevation)
+    hybrid_dbz.attrs['rad_lon'] = meta.lon
+    hybrid_dbz.attrs['rad_lat'] = meta.lat
+    hybrid_dbz.attrs['rad_alt'] = meta.alt
     return hybrid_dbz
@@ -1,5 +1,9 @@
+import hashlib
 import numpy as np
-from numba import jit_module
+from collections import OrderedDict
+from numba import jit_module, njit, prange
+
+_GEOMETRY_CACHE = OrderedDict()
 
 
 def _check_azi_diff(daz):
@@ -127,9 +131,237 @@ def sprint(vin, az, rg, xx, yy, beam_width=1.):
     return cv
 
 
+def _nearest_index(az, rg, xx, yy, beam_width=1.):
+    """flat index of the nearest radar gate of every cartesian pixel
+
+    Parameters
+    ----------
+    az :
+        azimuth angle (sorted)
+    rg :
+        distance (meter) from radar
+    xx, yy :
+        Cartesian coordinate values
+    beam_width : float
+        radar beam width
+
+    Returns
+    -------
+    2D int32 array
+        index into vin.ravel(), -1 outside range or in azimuth gaps
+    """
+
+    idx = np.full(xx.shape, -1, dtype=np.int32)
+    rreso = np.median(np.diff(rg))
+    nrg = len(rg)
+    naz = len(az)
+    maxrng = rg[-1]
+    for j in range(0, xx.shape[0]):
+        for i in range(0, xx.shape[1]):
+            rr = np.sqrt(xx[j, i]**2 + yy[j, i]**2)
+            if rr < maxrng:
+                angle = np.arctan2(yy[j, i], xx[j, i])
+                angle = (90. - np.rad2deg(angle)) % 360.
+                az_flag = np.searchsorted(az, angle)
+                iaz_m = (az_flag - 1) % naz
+                iaz_p = az_flag % naz
+                daz = _check_azi_diff(az[iaz_p] - az[iaz_m])
+                if daz <= (2. * beam_width):
+                    irg = int(np.floor((rr - rg[0]) / rreso + 0.5))
+                    if irg >= 0 and irg <= (nrg - 1):
+                        daz_m = _check_azi_diff(angle - az[iaz_m])
+                        daz_p = _check_azi_diff(az[iaz_p] - angle)
+                        iaz = iaz_m if daz_m <= daz_p else iaz_p
+                        idx[j, i] = iaz * nrg + irg
+    return idx
+
+
+def _gate_bins(yp, yg0, dy, ny, y_r):
+    """counting sort of radar gates into the nearest output rows
+
+    Parameters
+    ----------
+    yp : 1D array
+        y coordinates of the gates
+    yg0, dy : float
+        origin and spacing of the rows of the regular grid
+    ny : int
+        number of rows
+    y_r : float
+        interpolation radius, gates farther than that outside the grid are
+        dropped and the others are binned into the edge rows
+
+    Returns
+    -------
+    offsets : 1D int array (ny + 1)
+        gates of row j are order[offsets[j]:offsets[j + 1]]
+    order : 1D int array
+        gate indices sorted by row
+    """
+    row = np.full(len(yp), -1, dtype=np.int64)
+    offsets = np.zeros(ny + 1, dtype=np.int64)
+    for g in range(len(yp)):
+        if yp[g] < yg0 - y_r or yp[g] > yg0 + (ny - 1) * dy + y_r:
+            continue
+        row[g] = min(max(int(np.floor((yp[g] - yg0) / dy + 0.5)), 0), ny - 1)
+        offsets[row[g] + 1] += 1
+    for j in range(ny):
+        offsets[j + 1] += offsets[j]
+    order = np.empty(offsets[-1], dtype=np.int64)
+    pos = offsets[:-1].copy()
+    for g in range(len(yp)):
+        if row[g] >= 0:
+            order[pos[row[g]]] = g
+            pos[row[g]] += 1
+    return offsets, order
+
+
 jit_module(nopython=True, cache=True, error_model='numpy')
 
 
+@njit(parallel=True, cache=True, error_model='numpy')
+def cressman_binned(vp, xp, yp, offsets, order, xg, yg, x_r=0.01, y_r=0.01):
+    """distance inversed weight interpolation of binned gates (see cressman2d)
+
+    Each output row only reads the gates binned into the rows within y_r and
+    only writes to itself, so rows are computed in parallel without write
+    conflicts.
+
+    Parameters
+    ----------
+    vp : 1D array
+        the value of gates, NaN gates are skipped
+    xp, yp : 1D array
+        the coordinates of gates
+    offsets, order : 1D int array
+        gate bins returned by _gate_bins
+    xg, yg : 1D array
+        the coodinates of regular grid
+    x_r, y_r : float
+        interpolation radius
+
+    Returns
+    -------
+    2D array
+        the interpolated value on the regular grids
+    """
+    nx, ny = len(xg), len(yg)
+    dx = xg[1] - xg[0]
+    ky = int(np.ceil(y_r / np.abs(yg[1] - yg[0]) + 0.5))
+    R2 = x_r ** 2. + y_r ** 2.
+    vg = np.zeros((ny, nx), dtype=vp.dtype)
+    wt = np.zeros((ny, nx), dtype=vp.dtype)
+    for jj in prange(ny):
+        for bj in range(max(jj - ky, 0), min(jj + ky, ny - 1) + 1):
+            for k in range(offsets[bj], offsets[bj + 1]):
+                g = order[k]
+                y_dis = yp[g] - yg[jj]
+                if np.isnan(vp[g]) or np.abs(y_dis) > y_r:
+                    continue
+                im = max(int(np.floor((xp[g] - x_r - xg[0]) / dx)), 0)
+                ip = min(int(np.ceil((xp[g] + x_r - xg[0]) / dx)), nx - 1)
+                for ii in range(im, ip + 1):
+                    x_dis = xp[g] - xg[ii]
+                    if np.abs(x_dis) <= x_r:
+                        rSquare = (x_dis ** 2 + y_dis ** 2) / R2
+                        if rSquare < 1:
+                            tmp = (1 - rSquare) / (1 + rSquare)
+                            wt[jj, ii] = wt[jj, ii] + tmp
+                            vg[jj, ii] = vg[jj, ii] + tmp * vp[g]
+        for ii in range(nx):
+            if wt[jj, ii] > 0.:
+                vg[jj, ii] = vg[jj, ii] / wt[jj, ii]
+            else:
+                vg[jj, ii] = np.nan
+    return vg
+
+
+def _geometry_cached(name, arrays, extra, build):
+    """result of build() cached by a hash of the remap geometry"""
+    h = hashlib.sha1(name.encode())
+    for v in arrays:
+        v = np.asarray(v)
+        h.update(f'{v.shape}'.encode())
+        h.update(np.ascontiguousarray(v, dtype='f8').tobytes())
+    h.update(repr(extra).encode())
+    key = h.hexdigest()
+    if key in _GEOMETRY_CACHE:
+        _GEOMETRY_CACHE.move_to_end(key)
+    else:
+        _GEOMETRY_CACHE[key] = build()
+        if len(_GEOMETRY_CACHE) > 8:
+            _GEOMETRY_CACHE.popitem(last=False)
+    return _GEOMETRY_CACHE[key]
+
+
+def gate_bins(az, rg, xg, yg, x_r=0.01, y_r=0.01):
+    """gate coordinates and bins of a reorder geometry, computed once and cached
+
+    Parameters
+    ----------
+    az :
+        azimuth angle
+    rg :
+        ground distance (meter) from radar
+    xg, yg : 1D array
+        the coodinates of regular grid
+    x_r, y_r : float
+        interpolation radius
+
+    Returns
+    -------
+    xp, yp, offsets, order : 1D arrays
+        flattened gate coordinates and their row bins (see _gate_bins)
+    """
+    def build():
+        rad_azi = np.deg2rad(np.asarray(az, dtype='f8'))
+        xp = (np.sin(rad_azi[:, np.newaxis]) * rg[np.newaxis, :]).ravel()
+        yp = (np.cos(rad_azi[:, np.newaxis]) * rg[np.newaxis, :]).ravel()
+        offsets, order = _gate_bins(yp, float(yg[0]), np.median(np.diff(yg)), len(yg), y_r)
+        return xp, yp, offsets, order
+    return _geometry_cached('reorder', (az, rg, xg, yg), (x_r, y_r), build)
+
+
+def nearest_index(az, rg, xx, yy, beam_width=1., geometry=None):
+    """nearest gate index of a remap geometry, computed once and cached
+
+    Parameters
+    ----------
+    az :
+        azimuth angle (sorted)
+    rg :
+        distance (meter) from radar
+    xx, yy :
+        Cartesian coordinate values
+    beam_width : float
+        radar beam width
+    geometry : tuple
+        small parameters xx, yy are built from (e.g. max_rng, grid_reso),
+        used in the cache key instead of hashing xx, yy on every call
+
+    Returns
+    -------
+    2D int32 array
+        index into vin.ravel(), -1 outside range or in azimuth gaps
+    """
+    if geometry is None:
+        arrays, extra = (az, rg, xx, yy), beam_width
+    else:  # 坐标由geometry确定，只对方位角和距离库计算哈希
+        arrays, extra = (az, rg), (beam_width, np.shape(xx), tuple(geometry))
+    return _geometry_cached('nearest', arrays, extra,
+                            lambda: _nearest_index(np.asarray(az, dtype='f8'),
+                                                   np.asarray(rg, dtype='f8'),
+                                                   np.asarray(xx, dtype='f8'),
+                                                   np.asarray(yy, dtype='f8'), beam_width))
+
+
+def nearest(vin, idx):
+    """remap a PPI with a nearest gate index (see nearest_index)"""
+    vin = np.asarray(vin, dtype=np.result_type(vin, np.float32))
+    # 末尾补NaN，-1索引按wrap模式取到NaN
+    return np.take(np.append(vin.ravel(), np.nan), idx, mode='wrap')
+
+
 def to_enu(xx, yy, *args, method='nearest', **kargs):
     """interpolate a radar PPI to ENU cartesian coordinate
 
@@ -145,6 +377,9 @@ def to_enu(xx, yy, *args, method='nearest', **kargs):
         interpolation method: 'nearest', 'sprint', 'reorder'
     beam_width: float
         beam_width of radar
+    geometry: tuple
+        parameters xx, yy are built from, the cache key of the 'nearest'
+        index (see nearest_index)
 
     Returns
     -------
@@ -177,18 +412,18 @@ def to_enu(xx, yy, *args, method='nearest', **kargs):
 
     beam_width = kargs.pop('beam_width', 1.)
     if method == 'nearest':
-        return interp.nearest_op_numba(arr, az, rg * cos_el, xx, yy, beam_width)
+        return nearest(arr, nearest_index(az, rg * cos_el, xx, yy, beam_width,
+                                          geometry=kargs.get('geometry')))
     elif method == 'sprint':
         return sprint(arr, az, rg * cos_el, xx, yy, beam_width)
     elif method == 'reorder':
-        rad_azi = np.deg2rad(az)
-        xp = np.sin(rad_azi[:, np.newaxis]) * rg[np.newaxis, :] * cos_el
-        yp = np.cos(rad_azi[:, np.newaxis]) * rg[np.newaxis, :] * cos_el
-        flag = np.logical_not(np.isnan(arr))
-        xg = xx[0, :]
-        yg = np.array(yy[:, 0])
-        vg = cressman2d(xp[flag], yp[flag], arr[flag],
-                                 xg, yg, **kargs)
+        # 坐标和距离库分组按float64计算并缓存，只有vin按输入精度计算
+        xg = np.ascontiguousarray(xx[0, :], dtype='f8')
+        yg = np.ascontiguousarray(yy[:, 0], dtype='f8')
+        x_r, y_r = kargs.get('x_r', 0.01), kargs.get('y_r', 0.01)
+        xp, yp, offsets, order = gate_bins(az, rg * cos_el, xg, yg, x_r, y_r)
+        vg = cressman_binned(np.ascontiguousarray(arr).ravel(), xp, yp, offsets, order,
+                             xg, yg, x_r, y_r)
         return vg
     else:
         raise ValueError(f'interp method "{method}" not implemented')
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import types
+import random
+import importlib.util
+import click
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from pyzstd import decompress
+from ywqpe.io import scan_time
+from ywqpe.reproc import gauge_read, scan_index
+
+
+class _Record:
+    """plain attribute record returned by the local CachePy"""
+
+    def __init__(self, **kargs):
+        self.__dict__.update(kargs)
+
+
+class CachePy:
+    """local stand-in of cachepy.CachePy backed by files
+
+    Radar products are served from a directory of HSR files named as
+    'YW_RADA_{oflag}_{originator}_{%Y%m%d%H%M%S}_{ftype}_{deviceId}_{equType}_*',
+    gauge queries from a directory of gauge csv files (see io.stn_read), and
+    saved products are written to a local directory. Each method sleeps for
+    the configured latency and fails with the configured probability.
+
+    The configuration is shared by all instances and set by install().
+    """
+
+    config = {}
+
+    def __init__(self, name=None):
+        self.name = name
+        self.handles = {}
+        self.saved = []
+
+    def _call(self, method):
+        cfg = self.config
+        delay = cfg.get('latency', {})
+        time.sleep(delay.get(method, 0.) if isinstance(delay, dict) else delay)
+        fail = cfg.get('fail', {})
+        return random.random() < (fail.get(method, 0.) if isinstance(fail, dict) else fail)
+
+    def createClient(self, appName, serverName):
+        self._call('createClient')
+        return True
+
+    def echo(self):
+        self._call('echo')
+        return True
+
+    def getLocalStorePath(self):
+        self._call('getLocalStorePath')
+        return self.config['work_dir']
+
+    def queryRadarProduct(self, stationId, nStation, dependentId, start, end, limit, ttl=100):
+        """latest limit files observed in (start, end] (epoch seconds)"""
+        failed = self._call('queryRadarProduct')
+        fps = self.config['scans']
+        if failed:
+            sel = []
+        else:
+            t0 = pd.Timestamp(datetime.fromtimestamp(start))
+            t1 = pd.Timestamp(datetime.fromtimestamp(end))
+            sel = list(fps[(fps.index > t0) & (fps.index <= t1)].values[::-1][:max(int(limit), 1)])
+        handle = len(self.handles)
+        self.handles[handle] = sel
+        return _Record(handle=handle, dataCnt=len(sel))
+
+    def getRadarProduct(self, handle, index):
+        if self._call('getRadarProduct'):
+            return None
+        fps = self.handles.get(handle, [])
+        if index >= len(fps):
+            return None
+        fp = fps[index]
+        with open(fp, 'rb') as f:
+            buf = f.read()
+        if fp.endswith('.zst'):  # 服务端返回解压后的数据
+            buf = decompress(buf)
+        return _Record(name=os.path.split(fp)[1], data=buf)
+
+    def parseFileName(self, name):
+        self._call('parseFileName')
+        fields = os.path.split(name)[1].split('.')[0].split('_')
+        attrs = dict(zip(['oflag', 'originator', 'szDateTime', 'ftype', 'deviceId', 'equType'],
+                         fields[2:8]))
+        attrs['tm'] = int(time.mktime(scan_time(name).timetuple()))
+        return _Record(**attrs)
+
+    def pbReq(self, data):
+        """answer a serialized NrsReq (GetAutoStation) with a serialized NrsResp"""
+        from nrsproto.nrsbase_pb2 import NrsReq, NrsResp, CmdType
+
+        if self._call('pbReq'):
+            return False, b'injected failure'
+        req = NrsReq()
+        req.ParseFromString(data)
+        if req.cmd != CmdType.GetAutoStation:
+            return False, f'cmd {req.cmd} not supported by local CachePy'.encode()
+        df = self.config['gauges']
+        t0 = pd.Timestamp(datetime.fromtimestamp(req.autoStation.startTime))
+        t1 = pd.Timestamp(datetime.fromtimestamp(req.autoStation.endTime))
+        df = df[(df.Datetime >= t0) & (df.Datetime <= t1)]
+        for cond in req.autoStation.conds:
+            if cond.dataName == 'value':
+                df = df[(df.rain >= cond.min) & (df.rain <= cond.max)]
+
+        resp = NrsResp()
+        for row in df.itertuples():
+            item = resp.autoStation.data.add()
+            item.dataTime = int(time.mktime(row.Datetime.timetuple()))
+            item.stationId = str(row.Station_Id_c)
+            item.lon, item.lat, item.rain = row.Lon, row.Lat, row.rain
+        return True, resp.SerializeToString()
+
+    def saveRadarProduct(self, isTemp, stationId, name, ename, proId, buf):
+        if self._call('saveRadarProduct'):
+            return False, 'injected failure'
+        out_dir = os.path.join(self.config['out_dir'], str(stationId))
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, name), 'wb') as f:
+            f.write(bytes(buf))
+        self.saved.append(name)
+        return True, name
+
+
+def install(rad_dir, stn_dir, work_dir, out_dir=None, latency=0., fail=0.):
+    """register the local CachePy as module 'cachepy'
+
+    Parameters
+    ----------
+    rad_dir, stn_dir : str
+        directories of HSR files and gauge csv files
+    work_dir : str
+        returned by getLocalStorePath
+    out_dir : str
+        directory of saved products, work_dir/saved if None
+    latency : float or dict
+        injected delay (seconds), per method name if dict
+    fail : float or dict
+        injected failure probability, per method name if dict
+
+    Returns
+    -------
+    module
+    """
+    CachePy.config = {'scans': scan_index(rad_dir),
+                      'gauges': gauge_read(stn_dir, pd.Timestamp.min, pd.Timestamp.max),
+                      'work_dir': work_dir,
+                      'out_dir': out_dir or os.path.join(work_dir, 'saved'),
+                      'latency': latency, 'fail': fail}
+    module = types.ModuleType('cachepy')
+    module.CachePy = CachePy
+    sys.modules['cachepy'] = module
+    return module
+
+
+def _load(script):
+    """load qpe_proc.py (path) after install()
+
+    ywqpe.cli is not supported: it expects local radar files named as
+    '%Y%m%d_%H%M%S', which the local CachePy does not serve.
+    """
+    spec = importlib.util.spec_from_file_location('_replay_target', script)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def replay(script, cfg, start, ncycles=240, cycle=360):
+    """run the operational qpe command for simulated cycles
+
+    Parameters
+    ----------
+    script : str
+        path of qpe_proc.py
+    cfg : dict
+        configuration of the qpe command, 'time' is set for every cycle
+    start : datetime
+        time of the first cycle
+    ncycles : int
+        number of cycles, 240 cycles of 6 minutes is a day
+    cycle : int
+        cycle interval (seconds)
+
+    Returns
+    -------
+    pd.DataFrame
+        per-cycle 'time', 'latency' (seconds), 'ok' and 'error'
+    """
+    qpe = _load(script).qpe.callback
+    t0 = int(time.mktime(start.timetuple()))
+    rows = []
+    for k in range(ncycles):
+        cfg = dict(cfg, time=t0 + k * cycle)
+        arg = json.dumps(cfg)
+        tic = time.perf_counter()
+        try:
+            qpe(arg)
+            ok, error = True, ''
+        except Exception as e:  # 记录失败周期，继续回放
+            ok, error = False, f'{type(e).__name__}: {e}'
+        rows.append({'time': datetime.fromtimestamp(cfg['time']), 'latency': time.perf_counter() - tic,
+                     'ok': ok, 'error': error})
+        print(f"cycle {k}: {rows[-1]['latency']:.2f}s {'ok' if ok else error}")
+    return pd.DataFrame(rows)
+
+
+def summary(df):
+    """latency percentiles (seconds) and failures of a replay"""
+    lat = df['latency'].values
+    out = {f'p{q}': np.percentile(lat, q) for q in (50, 90, 95, 99)}
+    out.update({'max': lat.max(), 'cycles': len(df), 'failed': int((~df['ok']).sum())})
+    return out
+
+
+@click.command()
+@click.argument('cfg')
+@click.argument('rad_dir')
+@click.argument('stn_dir')
+@click.argument('work_dir')
+@click.option('--script', default='qpe_proc.py', help='qpe_proc.py path')
+@click.option('--start', required=True, help='time of the first cycle (%Y%m%d%H%M)')
+@click.option('--cycles', default=240, help='number of 6-minute cycles')
+@click.option('--latency', default='0', help='injected latency (s), a number or json per method')
+@click.option('--fail', default='0', help='injected failure probability, a number or json per method')
+@click.option('--output', default=None, help='csv of per-cycle latency')
+def cli(cfg, rad_dir, stn_dir, work_dir, script, start, cycles, latency, fail, output):
+    """: replay the qpe command offline against a local CachePy"""
+
+    install(rad_dir, stn_dir, work_dir, latency=json.loads(latency), fail=json.loads(fail))
+    df = replay(script, json.load(open(cfg)), datetime.strptime(start, "%Y%m%d%H%M"),
+                ncycles=cycles)
+    if output:
+        df.to_csv(output, index=False)
+    for k, v in summary(df).items():
+        print(f'{k}: {v:.3f}' if isinstance(v, float) else f'{k}: {v}')
+
+
+if __name__ == '__main__':
+    cli()
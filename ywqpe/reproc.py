@@ -0,0 +1,236 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ywqpe import clutter, core, store
+from ywqpe.io import TAR_EXT, hsr_archive, scan_time, stn_read, tar_members
+
+
+class WindowSum:
+    """running sums of rain rate over trailing windows (t - window, t]
+
+    every scan is added once and subtracted once when it leaves a window, so
+    all windows are updated in O(1) field operations per scan
+    """
+
+    def __init__(self, windows):
+        self.windows = sorted(windows)
+        self.times, self.fields = [], []
+        self.start = {w: 0 for w in self.windows}
+        self.nscan = {w: 0 for w in self.windows}
+        self.total = {}
+        self.count = {}
+
+    def push(self, t, rain):
+        """add a scan observed at t and drop scans out of the windows
+
+        Parameters
+        ----------
+        t : datetime
+            observation time of the scan
+        rain : 2D array
+            rain rate of the scan
+        """
+        self.times.append(t)
+        self.fields.append(rain)
+        for w in self.windows:
+            if w not in self.total:
+                self.total[w] = np.zeros(rain.shape, dtype='f8')
+                self.count[w] = np.zeros(rain.shape, dtype='i2')
+            self.total[w] += rain
+            self.count[w] += rain > 0.
+            self.nscan[w] += 1
+            while self.times[self.start[w]] <= t - timedelta(minutes=w):
+                old = self.fields[self.start[w]]
+                self.total[w] -= old
+                self.count[w] -= old > 0.
+                self.nscan[w] -= 1
+                self.start[w] += 1
+
+        # 最长窗口之外的扫描不再需要
+        drop = self.start[self.windows[-1]]
+        if drop > 0:
+            del self.times[:drop], self.fields[:drop]
+            for w in self.windows:
+                self.start[w] -= drop
+
+    def mean(self, w):
+        """mean rain rate of window w, exact 0 where no scan has rain"""
+        return np.where(self.count[w] > 0, self.total[w] / max(self.nscan[w], 1), 0.)\
+            .astype('float32')
+
+
+def min_scans(window, scan_reso=6.):
+    """least number of scans required by a window (same rule as ywqpe.cli)"""
+    if int(window) == 10:
+        return int(np.around(window / scan_reso))
+    return int(np.around((window / scan_reso) * (3 / 4)))
+
+
+def scan_index(rad_dir):
+    """index HSR files under rad_dir by observation time
+
+    Parameters
+    ----------
+    rad_dir : str
+        directory (searched recursively) of HSR files and tar bundles of them
+
+    Returns
+    -------
+    pd.Series
+        file paths indexed and sorted by scan time, members of tar bundles
+        as '<bundle>/<member>' (see io.hsr_archive)
+    """
+    fps, times = [], []
+    for fp in glob.glob(os.path.join(rad_dir, '**', '*'), recursive=True):
+        if not os.path.isfile(fp):
+            continue
+        if fp.endswith(TAR_EXT):  # 按天打包的文件，不解包
+            for member in tar_members(fp):
+                try:
+                    times.append(scan_time(member))
+                    fps.append(member)
+                except (IndexError, ValueError):
+                    continue
+            continue
+        try:
+            t = scan_time(fp)
+        except (IndexError, ValueError):  # 非雷达文件
+            continue
+        fps.append(fp)
+        times.append(t)
+    return pd.Series(fps, index=pd.DatetimeIndex(times), dtype=object).sort_index()
+
+
+def gauge_read(stn_dir, start, end):
+    """read gauge csv files under stn_dir observed in (start, end]"""
+    fps = sorted(glob.glob(os.path.join(stn_dir, '**', '*.csv'), recursive=True))
+    if len(fps) == 0:
+        return pd.DataFrame(columns=['Datetime', 'Station_Id_c', 'Lon', 'Lat', 'rain'])
+    df = pd.concat([stn_read(fp) for fp in fps], ignore_index=True)
+    df = df[(df.Datetime > start) & (df.Datetime <= end)]
+    return df.drop_duplicates(subset=['Datetime', 'Station_Id_c']).sort_values(by=['Datetime'])
+
+
+def product_name(params, t, window):
+    return f"{params.get('stationId', 'Z9280')}_{t:%Y%m%d_%H%M%S}_M{window}.nc"
+
+
+def reprocess_chunk(start, end, fps, df, params, out_dir, windows=(10, 30, 60), io_workers=2):
+    """reprocess the scans observed in [start, end)
+
+    Scans are decoded in time order by io.hsr_archive, each exactly once, so
+    the remapped scans cache is not used here.
+
+    Parameters
+    ----------
+    start, end : datetime
+        time range of the output products
+    fps : pd.Series
+        HSR files (or tar members, see scan_index) indexed by scan time,
+        including the lead-in of the longest window before start
+    df : pd.DataFrame
+        observations of gauges
+    params : dict
+        config params for qpe
+    out_dir : str
+        root directory of the products, one sub-directory per day
+    windows : list of int
+        accumulation windows (minutes)
+    io_workers : int
+        number of decoding threads
+
+    Returns
+    -------
+    int
+        number of products written
+    """
+    grid_reso = (params.get('gridReso') / 0.01) * 1e3
+    scan_reso = params.get('scanReso', 6.)
+    dtype = params.get('dtype', 'float64')
+    mask = clutter.site_mask(params)
+    ws = WindowSum(windows)
+    n = 0
+    scans = hsr_archive(list(fps[fps.index < end].values), workers=io_workers, dtype=dtype)
+    for polar, meta in scans:
+        t = meta.time
+        dbz, grid = core.remap_polar(polar, meta, [grid_reso],
+                                     method=params.get('remap', 'sprint'),
+                                     packed=params.get('packed', False), dtype=dtype,
+                                     mask=mask)[0]
+        ws.push(t, core._to_rain(dbz, A=params.get('A', 300.), b=params.get('b', 1.4)))
+        if t < start:  # 窗口预热扫描
+            continue
+
+        day_dir = os.path.join(out_dir, f'{t:%Y%m%d}')
+        os.makedirs(day_dir, exist_ok=True)
+        for w in windows:
+            out_name = product_name(params, t, w)
+            output = os.path.join(day_dir, out_name)
+            if os.path.exists(output) or ws.nscan[w] < min_scans(w, scan_reso):
+                continue
+            stn = df[(df.Datetime > t - timedelta(minutes=w)) & (df.Datetime <= t)]
+            ds_qpe = core.qpe_product(grid, ws.mean(w), core.stn_accum(stn, params), params)
+            # 先写临时文件再重命名，中断后不会留下不完整产品
+            tmp = os.path.join(day_dir, f'.{out_name}')
+            ds_qpe.to_netcdf(tmp)
+            os.replace(tmp, output)
+            store.store_sink(params, ds_qpe, t, f'M{w}')
+            n += 1
+    return n
+
+
+def reprocess(rad_dir, stn_dir, start, end, params, out_dir, windows=(10, 30, 60), workers=1,
+              io_workers=2):
+    """reprocess an archive of HSR files into 10/30/60 min products
+
+    Each day is processed by one worker process, which decodes and remaps
+    every scan once and keeps sliding window sums for all windows. Finished
+    days are marked in out_dir and skipped on rerun; inside an unfinished
+    day, products already written are skipped.
+
+    Parameters
+    ----------
+    rad_dir, stn_dir : str
+        directories of HSR files (or tar bundles of them) and gauge csv files
+    start, end : datetime
+        time range [start, end) of the output products
+    params : dict
+        config params for qpe
+    out_dir : str
+        root directory of the products
+    windows : list of int
+        accumulation windows (minutes)
+    workers : int
+        number of worker processes
+    io_workers : int
+        number of decoding threads of every worker process
+    """
+    lead = timedelta(minutes=max(windows))
+    fps = scan_index(rad_dir)
+    df = gauge_read(stn_dir, start - lead, end)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {}
+        for day in pd.date_range(pd.Timestamp(start).floor('D'), end, freq='D', inclusive='left'):
+            day = day.to_pydatetime()
+            t0, t1 = max(day, start), min(day + timedelta(days=1), end)
+            marker = os.path.join(out_dir, f'{day:%Y%m%d}', '.done')
+            if os.path.exists(marker):
+                print(f'skip finished day {day:%Y%m%d}')
+                continue
+            day_fps = fps[(fps.index > t0 - lead) & (fps.index < t1)]
+            day_df = df[(df.Datetime > t0 - lead) & (df.Datetime <= t1)]
+            job = pool.submit(reprocess_chunk, t0, t1, day_fps, day_df, params, out_dir, windows,
+                              io_workers)
+            jobs[job] = (day, t1 - t0 == timedelta(days=1))
+
+        for job in as_completed(jobs):
+            day, full_day = jobs[job]
+            n = job.result()
+            print(f'{day:%Y%m%d}: {n} products')
+            if full_day:
+                os.makedirs(os.path.join(out_dir, f'{day:%Y%m%d}'), exist_ok=True)
+                open(os.path.join(out_dir, f'{day:%Y%m%d}', '.done'), 'w').close()
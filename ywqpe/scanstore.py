@@ -0,0 +1,196 @@
+import os
+import json
+import fcntl
+import bisect
+import hashlib
+from datetime import datetime
+from ywqpe.io import scan_time
+
+_TFMT = '%Y%m%d%H%M%S'
+
+
+class ScanStore:
+    """local directory of radar scans indexed by a persistent manifest
+
+    'manifest.json' lists (time, site, name, size, sha1) of every scan sorted
+    by time, so a window query is two bisections instead of a glob and a
+    strptime per file. Writers hold an exclusive flock on '.lock' while they
+    update the manifest, which is replaced atomically; readers only reload it
+    when it has changed.
+
+    Parameters
+    ----------
+    root : str
+        store directory
+    parse : callable
+        observation time of a file name, used when add() gets no time and to
+        index files of a directory without manifest
+    """
+
+    def __init__(self, root, parse=scan_time):
+        self.root = root
+        self.parse = parse
+        self.entries, self.times = [], []
+        self._stamp = None
+        os.makedirs(root, exist_ok=True)
+        if not os.path.exists(self.manifest):
+            self.rebuild()
+
+    @property
+    def manifest(self):
+        return os.path.join(self.root, 'manifest.json')
+
+    def _lock(self):
+        f = open(os.path.join(self.root, '.lock'), 'w')
+        fcntl.flock(f, fcntl.LOCK_EX)  # 关闭文件时释放
+        return f
+
+    def _load(self):
+        """reload the manifest if another process has replaced it"""
+        try:
+            st = os.stat(self.manifest)
+        except FileNotFoundError:
+            self.entries, self.times, self._stamp = [], [], None
+            return
+        stamp = (st.st_ino, st.st_mtime_ns)
+        if stamp != self._stamp:
+            with open(self.manifest) as f:
+                self.entries = json.load(f)
+            self.times = [e['time'] for e in self.entries]
+            self._stamp = stamp
+
+    def _save(self):
+        tmp = f'{self.manifest}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.manifest)
+        self.times = [e['time'] for e in self.entries]
+        self._stamp = None
+
+    def _entry(self, name, t, site):
+        path = os.path.join(self.root, name)
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return {'time': f'{t:{_TFMT}}', 'site': site, 'name': name,
+                'size': os.path.getsize(path), 'sha1': h.hexdigest()}
+
+    def _insert(self, entry):
+        self.entries = [e for e in self.entries if e['name'] != entry['name']]
+        times = [e['time'] for e in self.entries]
+        self.entries.insert(bisect.bisect_right(times, entry['time']), entry)
+
+    def __len__(self):
+        self._load()
+        return len(self.entries)
+
+    def add(self, name, data, t=None, site=''):
+        """write a scan and index it
+
+        Parameters
+        ----------
+        name : str
+            file name in the store
+        data : bytes-like
+            file content
+        t : datetime
+            observation time, parsed from name if None
+        site : str
+            radar station id
+
+        Returns
+        -------
+        str
+            file path
+        """
+        t = t or self.parse(name)
+        path = os.path.join(self.root, name)
+        # 先写临时文件再重命名，读者不会拿到不完整的文件
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        entry = self._entry(name, t, site)
+        with self._lock():
+            self._load()
+            self._insert(entry)
+            self._save()
+        return path
+
+    def latest(self):
+        """observation time of the newest scan, None if the store is empty"""
+        self._load()
+        return datetime.strptime(self.times[-1], _TFMT) if self.times else None
+
+    def window(self, start, end, site=None):
+        """paths of the scans observed in (start, end], sorted by time"""
+        self._load()
+        i = bisect.bisect_right(self.times, f'{start:{_TFMT}}')
+        j = bisect.bisect_right(self.times, f'{end:{_TFMT}}')
+        return [os.path.join(self.root, e['name']) for e in self.entries[i:j]
+                if site is None or e['site'] == site]
+
+    def prune(self, keep, max_bytes=None):
+        """remove scans older than keep before the newest one
+
+        Parameters
+        ----------
+        keep : timedelta
+            scans observed in (latest - keep, latest] are kept
+        max_bytes : int
+            size bound, the oldest scans are also removed until it fits
+
+        Returns
+        -------
+        int
+            number of removed scans
+        """
+        with self._lock():
+            self._load()
+            if len(self.entries) == 0:
+                return 0
+            start = f'{datetime.strptime(self.times[-1], _TFMT) - keep:{_TFMT}}'
+            k = bisect.bisect_right(self.times, start)
+            if max_bytes is not None:
+                total = sum(e['size'] for e in self.entries[k:])
+                while k < len(self.entries) and total > max_bytes:
+                    total -= self.entries[k]['size']
+                    k += 1
+            old, self.entries = self.entries[:k], self.entries[k:]
+            for e in old:
+                try:
+                    os.remove(os.path.join(self.root, e['name']))
+                except FileNotFoundError:
+                    pass
+            if len(old) > 0:
+                self._save()
+        return len(old)
+
+    def verify(self):
+        """names of the indexed scans whose file is missing or changed"""
+        self._load()
+        bad = []
+        for e in self.entries:
+            try:
+                entry = self._entry(e['name'], datetime.strptime(e['time'], _TFMT), e['site'])
+            except FileNotFoundError:
+                bad.append(e['name'])
+                continue
+            if (entry['size'], entry['sha1']) != (e['size'], e['sha1']):
+                bad.append(e['name'])
+        return bad
+
+    def rebuild(self):
+        """index the scans already in the directory (e.g. before the manifest existed)"""
+        with self._lock():
+            self.entries = []
+            for d in os.scandir(self.root):
+                if not d.is_file() or d.name.startswith('.') or d.name.endswith(('.json', '.tmp')):
+                    continue
+                try:
+                    t = self.parse(d.name)
+                except (IndexError, ValueError):  # 非雷达文件
+                    continue
+                self._insert(self._entry(d.name, t, ''))
+            self._save()
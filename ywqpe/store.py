@@ -0,0 +1,213 @@
+import os
+import fcntl
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4 as nc
+
+_EPOCH = 'seconds since 1970-01-01 00:00:00'
+
+
+class ProductStore:
+    """appendable time series of one product of one radar
+
+    The grids are kept in a single netCDF4 file with an unlimited time
+    dimension, chunked by (time, latitude, longitude) and zlib compressed,
+    so a time range or a bounding box only reads the chunks it covers.
+    HDF5 files cannot be written by several processes, so writers hold an
+    exclusive flock on '<store>.lock' and readers a shared one.
+
+    Parameters
+    ----------
+    root : str
+        directory of the stores
+    radar_id : str
+        radar station id
+    product : str
+        product name, e.g. 'M60'
+    chunks : tuple of int
+        chunk size of (time, latitude, longitude)
+    grid_reso : float
+        grid resolution (degrees), part of the file name so that products of
+        different grids go to different stores
+    """
+
+    def __init__(self, root, radar_id, product, chunks=(24, 64, 64), grid_reso=None):
+        os.makedirs(root, exist_ok=True)
+        name = f'{radar_id}_{product}' if grid_reso is None else f'{radar_id}_{product}_{grid_reso}'
+        self.path = os.path.join(root, f'{name}.nc')
+        self.chunks = chunks
+
+    def _lock(self, exclusive=False):
+        f = open(f'{self.path}.lock', 'a')
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)  # 关闭文件时释放
+        return f
+
+    def _create(self, ds):
+        f = nc.Dataset(self.path, 'w')
+        f.createDimension('time', None)
+        f.createDimension('latitude', len(ds.latitude))
+        f.createDimension('longitude', len(ds.longitude))
+        t = f.createVariable('time', 'i8', ('time',))
+        t.units = _EPOCH
+        f.createVariable('latitude', 'f4', ('latitude',))[:] = ds.latitude.values
+        f.createVariable('longitude', 'f4', ('longitude',))[:] = ds.longitude.values
+        chunks = (self.chunks[0], min(self.chunks[1], len(ds.latitude)),
+                  min(self.chunks[2], len(ds.longitude)))
+        for name in ['qpe', 'qpe_oi']:
+            f.createVariable(name, 'f4', ('time', 'latitude', 'longitude'), zlib=True,
+                             complevel=4, shuffle=True, chunksizes=chunks, fill_value=np.nan)
+        f.setncatts({k: v for k, v in ds.attrs.items() if not isinstance(v, (dict, list))})
+        return f
+
+    def append(self, ds, t):
+        """append (or overwrite) the product of time t
+
+        Parameters
+        ----------
+        ds : xr.Dataset or xr.DataArray
+            output of core.qpe, contains 'qpe' and optionally 'qpe_oi'
+        t : datetime
+            product time
+        """
+        if isinstance(ds, xr.DataArray):
+            ds = ds.to_dataset(name='qpe')
+        with self._lock(exclusive=True):
+            self._append(ds, t)
+
+    def _append(self, ds, t):
+        f = nc.Dataset(self.path, 'a') if os.path.exists(self.path) else self._create(ds)
+        try:
+            shape = (len(f.dimensions['latitude']), len(f.dimensions['longitude']))
+            if shape != (len(ds.latitude), len(ds.longitude)):
+                raise ValueError(f'grid {(len(ds.latitude), len(ds.longitude))} of the product '
+                                 f'differs from {shape} of {self.path}')
+            stamp = int(pd.Timestamp(t).timestamp())
+            times = f['time'][:]
+            exist = np.flatnonzero(np.asarray(times) == stamp)
+            i = exist[0] if len(exist) > 0 else len(times)  # 重算的产品覆盖原有时次
+            f['time'][i] = stamp
+            for name in ['qpe', 'qpe_oi']:
+                if name in ds:
+                    f[name][i, :, :] = ds[name].values.astype('f4')
+                else:
+                    f[name][i, :, :] = np.nan
+        finally:
+            f.close()
+
+    def times(self):
+        """product times in the store"""
+        with self._lock(), nc.Dataset(self.path) as f:
+            return pd.to_datetime(np.asarray(f['time'][:]), unit='s')
+
+    @staticmethod
+    def _bbox(f, bbox):
+        if bbox is None:
+            return slice(None), slice(None)
+        lon_min, lon_max, lat_min, lat_max = bbox
+        lon, lat = f['longitude'][:], f['latitude'][:]
+        ix = np.flatnonzero((lon >= lon_min) & (lon <= lon_max))
+        iy = np.flatnonzero((lat >= lat_min) & (lat <= lat_max))
+        if len(ix) == 0 or len(iy) == 0:
+            return slice(0, 0), slice(0, 0)
+        return slice(iy[0], iy[-1] + 1), slice(ix[0], ix[-1] + 1)
+
+    def read(self, start, end, var='qpe', bbox=None):
+        """read products of time in [start, end]
+
+        Parameters
+        ----------
+        start, end : datetime
+            time range
+        var : str
+            'qpe' or 'qpe_oi'
+        bbox : tuple of float
+            (lon_min, lon_max, lat_min, lat_max), the whole grid if None
+
+        Returns
+        -------
+        3D xr.DataArray
+            dims ('time', 'latitude', 'longitude') sorted by time
+        """
+        with self._lock(), nc.Dataset(self.path) as f:
+            times = pd.to_datetime(np.asarray(f['time'][:]), unit='s')
+            idx = np.flatnonzero((times >= pd.Timestamp(start)) & (times <= pd.Timestamp(end)))
+            sy, sx = self._bbox(f, bbox)
+            if len(idx) > 0 and idx[-1] - idx[0] + 1 == len(idx):
+                data = f[var][idx[0]:idx[-1] + 1, sy, sx]
+            else:
+                data = f[var][idx, sy, sx]
+            da = xr.DataArray(np.ma.filled(data, np.nan), dims=('time', 'latitude', 'longitude'),
+                              coords={'time': times[idx], 'latitude': f['latitude'][sy],
+                                      'longitude': f['longitude'][sx]}, name=var)
+        return da.sortby('time')
+
+    def accumulate(self, start, end, freq='D', var='qpe', bbox=None, window=60, step=24):
+        """daily / monthly precipitation (mm) accumulated from the products
+
+        Each product (mean rain rate, mm/h) contributes rate * dt, where dt is
+        the time since the previous product, at most window minutes, so that
+        products of overlapping windows are not counted twice. NaN counts as
+        no rain. Products are read step time chunks at a time.
+
+        Parameters
+        ----------
+        start, end : datetime
+            time range
+        freq : str
+            'D' (daily) or 'M' (monthly)
+        var : str
+            'qpe' or 'qpe_oi'
+        bbox : tuple of float
+            (lon_min, lon_max, lat_min, lat_max), the whole grid if None
+        window : int
+            accumulation window (minutes) of the product
+        step : int
+            number of products read at a time
+
+        Returns
+        -------
+        3D xr.DataArray
+            dims ('period', 'latitude', 'longitude')
+        """
+        with self._lock(), nc.Dataset(self.path) as f:
+            times = pd.to_datetime(np.asarray(f['time'][:]), unit='s')
+            order = np.argsort(times)
+            sel = order[(times[order] >= pd.Timestamp(start)) & (times[order] <= pd.Timestamp(end))]
+            sy, sx = self._bbox(f, bbox)
+            lat, lon = f['latitude'][sy], f['longitude'][sx]
+
+            t = times[sel]
+            dt = np.diff(t.values, prepend=(t.values[:1] - np.timedelta64(window, 'm')))
+            hours = np.minimum(dt / np.timedelta64(1, 'h'), window / 60.)
+            periods = t.to_period(freq)
+            labels = periods.unique()
+            pos = {p: i for i, p in enumerate(labels)}
+            acc = np.zeros((len(labels), len(lat), len(lon)), dtype='f8')
+            for k in range(0, len(sel), step):
+                block = sel[k:k + step]
+                if np.all(np.diff(block) == 1):
+                    data = f[var][block[0]:block[-1] + 1, sy, sx]
+                else:
+                    data = f[var][np.sort(block), sy, sx]
+                    data = data[np.argsort(np.argsort(block))]
+                data = np.nan_to_num(np.ma.filled(data, np.nan), nan=0.)
+                for j in range(len(block)):
+                    acc[pos[periods[k + j]]] += data[j] * hours[k + j]
+        return xr.DataArray(acc.astype('f4'), dims=('period', 'latitude', 'longitude'),
+                            coords={'period': labels.astype(str), 'latitude': lat, 'longitude': lon},
+                            name=f'{var}_acc')
+
+
+def store_sink(params, ds, t, product):
+    """append a product to the store configured by params ('storeDir', 'gridReso')
+
+    The store is optional, a failure is printed and not raised so that it
+    never stops the product from being pushed.
+    """
+    if params.get('storeDir') and ds is not None:
+        try:
+            ProductStore(params['storeDir'], params.get('stationId', 'Z9280'), product,
+                         grid_reso=params.get('gridReso')).append(ds, t)
+        except Exception as e:  # 存储失败不影响产品推送
+            print(f'product store failed: {type(e).__name__}: {e}')